@@ -4,10 +4,11 @@ import idautils
 from ..dialogs.match import MatchDialog
 
 from .. import instances
-from .. import network, netnode, logger
+from .. import network, netnode, logger, config
 from . import base
 
 import hashlib
+import time
 
 
 class MatchAction(base.BoundFileAction):
@@ -18,10 +19,12 @@ class MatchAction(base.BoundFileAction):
     super(MatchAction, self).__init__(*args, **kwargs)
     self.functions = None
     self.pbar = None
+    self.progress = 0
+    self.progress_time = 0
     self.timer = None
     self.task_id = None
     self.file_version_id = None
-    self.instance_set = []
+    self.uploader = None
 
     self.source = None
     self.source_single = None
@@ -53,12 +56,27 @@ class MatchAction(base.BoundFileAction):
     self.target_file = target_file if target == 'file' else None
     self.methods = methods
 
+    if self.source == 'single':
+      # a single function is looked up directly, without uploading the idb
+      # or waiting for a match task
+      func = instances.FunctionInstance(None, self.source_single)
+      params = {'vectors': func.serialize()['vectors'],
+                'file': netnode.bound_file_id,
+                'target_project': self.target_project,
+                'target_file': self.target_file, 'methods': self.methods}
+      return network.QueryWorker("POST", "collab/instances/lookup/",
+                                 params=params, json=True)
+
     file_version_hash = self.calc_file_version_hash()
     uri = "collab/files/{}/file_version/{}/".format(netnode.bound_file_id,
                                                     file_version_hash)
     return network.QueryWorker("POST", uri, json=True)
 
-  def response_handler(self, file_version):
+  def response_handler(self, response):
+    if self.source == 'single':
+      return self.lookup_handler(response)
+
+    file_version = response
     self.file_version_id = file_version['id']
 
     if file_version['newly_created']:
@@ -68,18 +86,34 @@ class MatchAction(base.BoundFileAction):
 
     return True
 
+  @staticmethod
+  def lookup_handler(response):
+    for match in response['matches']:
+      logger('match_action').info("%s match of score %s at %s in file %s",
+                                  match['type'], match['score'],
+                                  hex(match['offset']), match['file'])
+    return True
+
   def start_upload(self):
     self.functions = set(idautils.Functions())
 
     self.pbar = QtWidgets.QProgressDialog()
     self.pbar.setLabelText("Processing IDB... You may continue working,\nbut "
                            "please avoid making any ground-breaking changes.")
-    self.pbar.setRange(0, len(self.functions))
+    # every function is advanced once when processed and once when uploaded
+    self.pbar.setRange(0, 2 * len(self.functions))
     self.pbar.setValue(0)
+    self.progress = 0
     self.pbar.canceled.connect(self.cancel_upload)
     self.pbar.rejected.connect(self.reject_upload)
     self.pbar.accepted.connect(self.accept_upload)
 
+    uploader = network.BatchUploader("collab/instances/stream/",
+                                     callback=self.progress_advance,
+                                     exception_callback=self.upload_exception,
+                                     ready_callback=self.resume_upload)
+    self.uploader = uploader
+
     self.timer = QtCore.QTimer()
     self.timer.timeout.connect(self.perform_upload)
     self.timer.start(0)
@@ -87,37 +121,66 @@ class MatchAction(base.BoundFileAction):
     return True
 
   def perform_upload(self):
+    # process as many functions as fit in a time slice, so per tick event
+    # loop overhead doesn't add up while the UI still gets to handle events
+    # between slices
+    deadline = time.time() + config['upload']['time_slice']
+    processed = 0
     try:
-      offset = self.functions.pop()
-    except KeyError:
-      self.timer.stop()
-      return
-
-    try:
-      func = instances.FunctionInstance(self.file_version_id, offset)
-      self.instance_set.append(func.serialize())
-
-      if len(self.instance_set) >= 100:
-        network.delayed_query("POST", "collab/instances/",
-                              params=self.instance_set, json=True,
-                              callback=self.progress_advance)
-        self.instance_set = []
-        self.pbar.setMaximum(self.pbar.maximum() + 1)
-      self.progress_advance()
+      while time.time() < deadline:
+        if not self.uploader.ready():
+          # processing is resumed once the uploader catches up
+          self.timer.stop()
+          break
+
+        try:
+          offset = self.functions.pop()
+        except KeyError:
+          self.timer.stop()
+          self.uploader.flush()
+          break
+
+        func = instances.FunctionInstance(self.file_version_id, offset)
+        self.uploader.add(func.serialize())
+        processed += 1
     except Exception:
       self.cancel_upload()
       raise
 
-  def progress_advance(self, result=None):
-    del result
-    new_value = self.pbar.value() + 1
-    self.pbar.setValue(new_value)
-    if new_value >= self.pbar.maximum():
+    if processed:
+      self.progress_advance(processed)
+
+  def resume_upload(self):
+    if self.timer:
+      self.timer.start(0)
+
+  def progress_advance(self, count=1):
+    if not self.pbar:
+      return
+
+    # repainting the progress dialog is costly, so it is updated at a bounded
+    # rate and once more when done
+    self.progress += count
+    now = time.time()
+    if self.progress >= self.pbar.maximum():
+      self.pbar.setValue(self.progress)
       self.pbar.accept()
+    elif now - self.progress_time >= config['upload']['progress_interval']:
+      self.progress_time = now
+      self.pbar.setValue(self.progress)
+
+  def upload_exception(self, exception):
+    if self.pbar:
+      self.cancel_upload()
+    raise exception
 
   def cancel_upload(self):
-    self.timer.stop()
+    if self.timer:
+      self.timer.stop()
+    if self.uploader:
+      self.uploader.cancel()
     self.timer = None
+    self.uploader = None
     self.pbar = None
 
   def reject_upload(self):
@@ -130,8 +193,6 @@ class MatchAction(base.BoundFileAction):
   def start_task(self):
     if self.source == 'idb':
       self.source_range = [None, None]
-    elif self.source == 'single':
-      self.source_range = [self.source_single, self.source_single]
     elif self.source == 'range':
       pass
     else:
@@ -158,33 +219,48 @@ class MatchAction(base.BoundFileAction):
     self.pbar.accepted.connect(self.accept_task)
     self.pbar.show()
 
-    self.timer = QtCore.QTimer()
-    self.timer.timeout.connect(self.perform_task)
-    self.timer.start(1000)
+    self.wait_task(r)
 
-  def perform_task(self):
-    try:
-      r = network.query("GET", "collab/tasks/{}/".format(self.task_id),
-                        json=True)
+  def wait_task(self, r):
+    # the server holds the request until the task changes, so the task is
+    # waited on in the network thread pool, away from the UI thread
+    params = {'status': r['status'], 'progress': r['progress']}
+    network.delayed_query("GET", "collab/tasks/{}/wait/".format(self.task_id),
+                          params=params, json=True,
+                          callback=self.perform_task,
+                          exception_callback=self.task_exception)
 
+  def task_exception(self, exception):
+    if self.pbar:
+      self.cancel_task()
+    raise exception
+
+  def perform_task(self, r):
+    # task was canceled while waiting
+    if not self.pbar:
+      return
+
+    try:
       progress_max = int(r['progress_max']) if r['progress_max'] else None
       progress = int(r['progress'])
       status = r['status']
       if status == 'failed':
         self.pbar.reject()
-      elif progress_max:
+      elif status == 'done':
+        self.pbar.accept()
+      elif progress_max and progress >= progress_max:
         self.pbar.setMaximum(progress_max)
-        if progress >= progress_max:
-          self.pbar.accept()
-        else:
+        self.pbar.accept()
+      else:
+        if progress_max:
+          self.pbar.setMaximum(progress_max)
           self.pbar.setValue(progress)
+        self.wait_task(r)
     except Exception:
       self.cancel_task()
       raise
 
   def cancel_task(self):
-    self.timer.stop()
-    self.timer = None
     self.pbar = None
 
   def reject_task(self):
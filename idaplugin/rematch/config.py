@@ -17,7 +17,17 @@ class Config(dict):
                                      "skipped": []},
                           "login": {"autologin": True,
                                     "autologout": False}},
-             "network": {"threadcount": 10}}
+             "network": {"threadcount": 10,
+                         "compress_threshold": 1024},
+             "upload": {"batch_bytes": 256 * 1024,
+                        "min_batch_bytes": 16 * 1024,
+                        "max_batch_bytes": 8 * 1024 * 1024,
+                        "max_inflight": 4,
+                        "target_latency": 2.0,
+                        "retries": 5,
+                        "backoff": 1.0,
+                        "time_slice": 0.03,
+                        "progress_interval": 0.1}}
 
   def __init__(self):
     super(Config, self).__init__()
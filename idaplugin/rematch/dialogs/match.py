@@ -36,17 +36,17 @@ class MatchDialog(base.BaseDialog):
     self.graph = QtWidgets.QCheckBox("Graph matches")
     self.identity.setChecked(True)
     self.fuzzy.setChecked(True)
-    self.graph.setChecked(True)
+    self.graph.setChecked(False)
+    self.graph.setDisabled(True)
+    self.graph.setToolTip("Graph matching is not currently supported. Plese "
+                          "express your need of this functionality at our "
+                          "github.")
     method_lyt = QtWidgets.QVBoxLayout()
     method_lyt.addWidget(self.identity)
     method_lyt.addWidget(self.fuzzy)
     method_lyt.addWidget(self.graph)
 
     method_gbx = QtWidgets.QGroupBox("Match methods")
-    method_gbx.setDisabled(True)
-    method_gbx.setToolTip("Match method control functionality is not "
-                          "currently supported. Plese express your need of "
-                          "this functionality at our github.")
     method_gbx.setLayout(method_lyt)
     self.base_layout.addWidget(method_gbx)
 
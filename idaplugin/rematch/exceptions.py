@@ -34,6 +34,11 @@ class UnknownObjectReferenceException(QueryException):
              "reproducable bug if this issue persists")
 
 
+class UploadRejectedException(QueryException):
+  message = ("Some of the uploaded functions were rejected by the server. "
+             "Please report a reproducable bug if this issue persists")
+
+
 class ConnectionException(QueryException):
   message = ("Can't connect to the server. Either your network connection is "
              "broken or the server is momentarily unavailable.")
@@ -62,7 +67,7 @@ def factory(ex):
     except Exception:
       response = response_text
     ex_cls = None
-    if ex.code == 500:
+    if ex.code >= 500:
       ex_cls = ServerException
     elif ex.code == 401:
       ex_cls = AuthenticationException
@@ -1,16 +1,113 @@
 from idasix import QtCore
 
+import collections
+import gzip
+import httplib
+import socket
+import threading
+import time
 import urllib
 import urllib2
+import zlib
+from Queue import LifoQueue, Empty
+from StringIO import StringIO
 from cookielib import CookieJar
 from json import loads, dumps
 
 import exceptions
 from . import config, logger
 
+
+class KeepAliveMixin:
+  """Mixin for urllib2 http handlers, reusing persistent connections kept in
+  a pool per host instead of opening a new connection for every request, and
+  decompressing gzip compressed responses.
+
+  Responses are read entirely before the connection is returned to the pool,
+  and requests failing on a pooled connection are retried once on a new
+  connection, as the server may have closed it while idle."""
+  def __init__(self):
+    self._pools = {}
+    self._pools_lock = threading.Lock()
+
+  def get_pool(self, key):
+    with self._pools_lock:
+      return self._pools.setdefault(key, LifoQueue())
+
+  def keep_alive_open(self, connection_cls, req):
+    host = req.get_host()
+    if not host:
+      raise urllib2.URLError('no host given')
+
+    headers = dict(req.unredirected_hdrs)
+    headers.update((k, v) for k, v in req.headers.items() if k not in headers)
+    headers = dict((name.title(), value) for name, value in headers.items())
+    headers['Connection'] = 'keep-alive'
+    headers['Accept-Encoding'] = 'gzip'
+
+    pool = self.get_pool((connection_cls, host))
+    try:
+      connection, reused = pool.get_nowait(), True
+    except Empty:
+      connection, reused = connection_cls(host, timeout=req.timeout), False
+
+    try:
+      response, body = self.fetch(connection, req, headers)
+    except (httplib.HTTPException, socket.error) as ex:
+      connection.close()
+      if not reused:
+        raise urllib2.URLError(ex)
+      connection = connection_cls(host, timeout=req.timeout)
+      try:
+        response, body = self.fetch(connection, req, headers)
+      except (httplib.HTTPException, socket.error) as ex:
+        connection.close()
+        raise urllib2.URLError(ex)
+
+    if response.will_close:
+      connection.close()
+    else:
+      pool.put(connection)
+
+    if response.getheader('content-encoding', '').lower() == 'gzip':
+      body = zlib.decompress(body, 16 + zlib.MAX_WBITS)
+
+    resp = urllib2.addinfourl(StringIO(body), response.msg,
+                              req.get_full_url())
+    resp.code = response.status
+    resp.msg = response.reason
+    return resp
+
+  @staticmethod
+  def fetch(connection, req, headers):
+    connection.request(req.get_method(), req.get_selector(), req.data,
+                       headers)
+    response = connection.getresponse()
+    return response, response.read()
+
+
+class KeepAliveHTTPHandler(KeepAliveMixin, urllib2.HTTPHandler):
+  def __init__(self):
+    urllib2.HTTPHandler.__init__(self)
+    KeepAliveMixin.__init__(self)
+
+  def http_open(self, req):
+    return self.keep_alive_open(httplib.HTTPConnection, req)
+
+
+class KeepAliveHTTPSHandler(KeepAliveMixin, urllib2.HTTPSHandler):
+  def __init__(self):
+    urllib2.HTTPSHandler.__init__(self)
+    KeepAliveMixin.__init__(self)
+
+  def https_open(self, req):
+    return self.keep_alive_open(httplib.HTTPSConnection, req)
+
+
 # building opener
 cookiejar = CookieJar()
-opener = urllib2.build_opener(urllib2.HTTPCookieProcessor(cookiejar))
+opener = urllib2.build_opener(urllib2.HTTPCookieProcessor(cookiejar),
+                              KeepAliveHTTPHandler(), KeepAliveHTTPSHandler())
 
 _threadpool = QtCore.QThreadPool()
 _threadpool.setMaxThreadCount(config['network']['threadcount'])
@@ -25,7 +122,7 @@ class WorkerSignals(QtCore.QObject):
 
 class QueryWorker(QtCore.QRunnable):
   def __init__(self, method, url, server=None, token=None, params=None,
-               json=False):
+               json=False, stream=False):
     super(QueryWorker, self).__init__()
 
     self.method = method
@@ -34,13 +131,14 @@ class QueryWorker(QtCore.QRunnable):
     self.token = token
     self.params = params
     self.json = json
+    self.stream = stream
 
     self.signals = WorkerSignals()
 
   def run(self):
     try:
       response = query(self.method, self.url, self.server, self.token,
-                       self.params, self.json)
+                       self.params, self.json, self.stream)
       if isinstance(response, dict):
         self.signals.result_dict.emit(response)
       elif isinstance(response, list):
@@ -56,8 +154,9 @@ def default_exception_callback(exception):
 
 
 def delayed_query(method, url, server=None, token=None, params=None,
-                  json=False, callback=None, exception_callback=None):
-  query_worker = QueryWorker(method, url, server, token, params, json)
+                  json=False, stream=False, callback=None,
+                  exception_callback=None):
+  query_worker = QueryWorker(method, url, server, token, params, json, stream)
   return delayed_worker(query_worker, callback, exception_callback)
 
 
@@ -72,13 +171,156 @@ def delayed_worker(query_worker, callback=None, exception_callback=None):
   _threadpool.start(query_worker)
 
 
-def query(method, url, server=None, token=None, params=None, json=False):
+class BatchUploader(object):
+  """Upload objects to url as newline delimited JSON streams, in batches cut
+  by their serialized size.
+
+  At most a bounded number of batches is in flight at once, and failed
+  batches are retried with an exponential backoff. Retries rely on the server
+  skipping objects it already stored, as a failed batch may have been
+  partially stored. Both the batch size and
+  the number of batches in flight adapt to the observed latency, growing
+  while requests complete well within the upload.target_latency config and
+  shrinking when requests are slow or fail.
+
+  callback is called with the number of objects of every uploaded batch,
+  and ready_callback whenever the uploader can accept objects again after
+  ready() returned False. Objects rejected by the server cancel the upload
+  and are reported to exception_callback."""
+  def __init__(self, url, callback=None, exception_callback=None,
+               ready_callback=None):
+    self.url = url
+    self.callback = callback
+    self.exception_callback = exception_callback or default_exception_callback
+    self.ready_callback = ready_callback
+
+    self.batch_bytes = config['upload']['batch_bytes']
+    self.inflight_limit = 1
+    self.inflight = 0
+    self.batch = []
+    self.batch_size = 0
+    self.pending = collections.deque()
+    self.canceled = False
+
+  @staticmethod
+  def max_inflight():
+    # requests waiting for a free network thread would only skew latency
+    return min(config['upload']['max_inflight'],
+               config['network']['threadcount'])
+
+  def ready(self):
+    """Return whether more objects should be added right away, or added
+    objects would just pile up waiting for batches in flight"""
+    return not self.pending and self.inflight < self.inflight_limit
+
+  def add(self, obj):
+    line = encode_line(obj)
+    if self.batch and self.batch_size + len(line) > self.batch_bytes:
+      self.flush()
+    self.batch.append(line)
+    self.batch_size += len(line)
+
+  def flush(self):
+    """Send the current partial batch"""
+    if self.batch:
+      self.pending.append(self.batch)
+      self.batch, self.batch_size = [], 0
+    self.send_pending()
+
+  def cancel(self):
+    self.canceled = True
+    self.pending.clear()
+
+  def send_pending(self):
+    while self.pending and self.inflight < self.inflight_limit:
+      self.inflight += 1
+      self.send(self.pending.popleft(), 0)
+
+  def send(self, batch, attempt):
+    if self.canceled:
+      return
+
+    start = time.time()
+
+    def callback(result):
+      self.batch_done(batch, time.time() - start, result)
+
+    def exception_callback(exception):
+      self.batch_failed(batch, attempt, exception)
+
+    delayed_query("POST", self.url, params="".join(batch), json=True,
+                  stream=True, callback=callback,
+                  exception_callback=exception_callback)
+
+  def batch_done(self, batch, latency, result):
+    self.inflight -= 1
+    if self.canceled:
+      return
+
+    if isinstance(result, dict) and result.get('rejected'):
+      logger('network').error("%s objects rejected by server: %s",
+                              result['rejected'], result.get('errors'))
+      self.cancel()
+      self.exception_callback(exceptions.UploadRejectedException(
+        rejected=result['rejected'], errors=result.get('errors')))
+      return
+
+    self.adapt(latency)
+    if self.callback:
+      self.callback(len(batch))
+
+    self.send_pending()
+    if self.ready() and self.ready_callback:
+      self.ready_callback()
+
+  def batch_failed(self, batch, attempt, exception):
+    if self.canceled:
+      self.inflight -= 1
+      return
+
+    upload_config = config['upload']
+    self.shrink()
+    transient = isinstance(exception, (exceptions.ConnectionException,
+                                       exceptions.ServerException))
+    if not transient or attempt >= upload_config['retries']:
+      self.inflight -= 1
+      self.cancel()
+      self.exception_callback(exception)
+      return
+
+    delay = upload_config['backoff'] * 2 ** attempt
+    logger('network').warning("Upload batch failed, retrying in %s seconds: "
+                              "%s", delay, exception)
+    QtCore.QTimer.singleShot(int(delay * 1000),
+                             lambda: self.send(batch, attempt + 1))
+
+  def adapt(self, latency):
+    upload_config = config['upload']
+    if latency < upload_config['target_latency'] / 2.0:
+      self.batch_bytes = min(self.batch_bytes * 2,
+                             upload_config['max_batch_bytes'])
+      self.inflight_limit = min(self.inflight_limit + 1, self.max_inflight())
+    elif latency > upload_config['target_latency']:
+      self.shrink()
+
+  def shrink(self):
+    self.batch_bytes = max(self.batch_bytes // 2,
+                           config['upload']['min_batch_bytes'])
+    self.inflight_limit = max(self.inflight_limit // 2, 1)
+
+
+def query(method, url, server=None, token=None, params=None, json=False,
+          stream=False):
+  """Issue a query to the server. If stream is set, params is a list of
+  objects posted as a newline delimited JSON stream, or an already encoded
+  stream. Request bodies of at least the network.compress_threshold config
+  bytes are gzip compressed."""
   if method not in ("GET", "POST"):
     raise exceptions.QueryException()
 
   server_url = get_server(server)
   full_url = server_url + url
-  headers = get_headers(token, json)
+  headers = get_headers(token, json, stream)
 
   logger('network').info("[query] %s%s%s", full_url, headers, params)
 
@@ -91,8 +333,14 @@ def query(method, url, server=None, token=None, params=None, json=False):
     elif method == "POST":
       if not params:
         params = ""
+      elif stream and not isinstance(params, str):
+        params = encode_stream(params)
       elif json:
         params = dumps(params)
+      threshold = config['network']['compress_threshold']
+      if isinstance(params, str) and len(params) >= threshold:
+        params = compress(params)
+        headers['Content-Encoding'] = 'gzip'
       request = urllib2.Request(full_url, data=params, headers=headers)
 
     response = opener.open(request)
@@ -127,13 +375,31 @@ def get_server(server):
   return server
 
 
-def get_headers(token, json):
+def encode_stream(objs):
+  """Serialize objects as a newline delimited JSON stream"""
+  return "".join(encode_line(obj) for obj in objs)
+
+
+def encode_line(obj):
+  return dumps(obj, separators=(',', ':')) + "\n"
+
+
+def compress(data):
+  compressed = StringIO()
+  with gzip.GzipFile(fileobj=compressed, mode='wb') as gzip_file:
+    gzip_file.write(data)
+  return compressed.getvalue()
+
+
+def get_headers(token, json, stream=False):
   """Setting up headers"""
 
   headers = {}
   if json:
     headers['Accept'] = 'application/json, text/html, */*'
     headers['Content-Type'] = 'application/json'
+  if stream:
+    headers['Content-Type'] = 'application/x-ndjson'
   if token is None and 'token' in config['login']:
     token = config['login']['token']
   if token:
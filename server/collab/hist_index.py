@@ -0,0 +1,90 @@
+"""Random projection locality sensitive hashing index for histogram vectors.
+
+Every indexed histogram is projected onto HISTOGRAM_INDEX_BANDS *
+HISTOGRAM_INDEX_BAND_BITS random hyperplanes, and the signs of the
+projections are split into bands. Each band is stored as a HistogramBucket
+row, so histograms with a high cosine similarity are likely to share at least
+one (band, key) bucket with each other, and candidates for a histogram can be
+looked up without scoring it against every other vector.
+"""
+
+import collections
+import hashlib
+
+from django.conf import settings
+
+import numpy as np
+
+from collab.models import Vector, HistogramBucket
+from collab import packing
+
+
+INDEXED_TYPES = (Vector.TYPE_MNEMONIC_HIST,)
+
+_hyperplanes = {}
+
+
+def signature_size():
+  return settings.HISTOGRAM_INDEX_BANDS * settings.HISTOGRAM_INDEX_BAND_BITS
+
+
+def hyperplane(feature):
+  """Return the hyperplane components of a single histogram feature.
+  Components are derived from the feature id alone so the same hyperplanes
+  are used by every process without sharing any state."""
+  size = signature_size()
+  if (feature, size) not in _hyperplanes:
+    seed = int(hashlib.md5(str(feature).encode('ascii')).hexdigest()[:8], 16)
+    components = np.random.RandomState(seed).standard_normal(size)
+    _hyperplanes[feature, size] = components
+  return _hyperplanes[feature, size]
+
+
+def signature(hist):
+  """Return a list of bucket keys, one per band, for a {mnemonic id: count}
+  histogram dict"""
+  projection = np.zeros(signature_size())
+  for feature, count in hist.items():
+    projection += count * hyperplane(feature)
+
+  band_bits = settings.HISTOGRAM_INDEX_BAND_BITS
+  bits = (projection >= 0).reshape(-1, band_bits)
+  return [int(key) for key in bits.dot(1 << np.arange(band_bits))]
+
+
+def index_vectors(vector_values):
+  """Store index buckets for an iterable of (id, type, packed) vector values.
+  Vectors of types which are not indexed are skipped."""
+  buckets = (HistogramBucket(vector_id=vector_id, band=band, key=key)
+             for vector_id, vector_type, packed in vector_values
+             if vector_type in INDEXED_TYPES
+             for band, key in enumerate(signature(packing.hist_dict(packed))))
+  HistogramBucket.objects.bulk_create(buckets, batch_size=10000)
+
+
+def query(source_hists, target, chunk_size=500, max_bucket_size=None):
+  """Return a set of (source index, target vector id) candidate pairs for a
+  list of {mnemonic id: count} histogram dicts, where target vectors are
+  limited to the target queryset.
+  A bucket shared by many target vectors, such as that of the many identical
+  tiny histograms of thunks, only contributes its first max_bucket_size
+  target vectors, bounding the candidates of every source histogram."""
+  band_keys = collections.defaultdict(lambda: collections.defaultdict(list))
+  for source_i, hist in enumerate(source_hists):
+    for band, key in enumerate(signature(hist)):
+      band_keys[band][key].append(source_i)
+
+  candidates = set()
+  for band, keys in band_keys.items():
+    key_list = list(keys)
+    for chunk_start in range(0, len(key_list), chunk_size):
+      chunk = key_list[chunk_start:chunk_start + chunk_size]
+      buckets = HistogramBucket.objects.filter(band=band, key__in=chunk,
+                                               vector__in=target)
+      bucket_sizes = collections.Counter()
+      for key, vector_id in buckets.values_list('key', 'vector_id').iterator():
+        bucket_sizes[key] += 1
+        if max_bucket_size and bucket_sizes[key] > max_bucket_size:
+          continue
+        candidates.update((source_i, vector_id) for source_i in keys[key])
+  return candidates
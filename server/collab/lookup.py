@@ -0,0 +1,42 @@
+"""Synchronous lookup of the best matches of a single function, answered
+within the request using indexed hash and histogram lookups instead of going
+through a match task and the celery queue.
+"""
+
+from collab.models import Instance
+from collab import matches
+
+
+def lookup(vectors, target, methods, top_k, min_score=None):
+  """Return a list of match dicts, sorted by descending score, for a list of
+  packed Vector objects of a single function against a target vector
+  queryset. At most top_k matches are returned for every match type."""
+  results = []
+  for match_type in matches.match_list:
+    if match_type.method not in methods:
+      continue
+
+    match_target = target.filter(type__in=match_type.get_vector_types())
+    type_results = match_type.lookup(vectors, match_target, top_k=top_k,
+                                     min_score=min_score)
+    type_results = sorted(type_results, key=lambda result: -result[4])
+    results.extend(type_results[:top_k])
+
+  instance_ids = set(result[3] for result in results)
+  instances = Instance.objects.filter(id__in=instance_ids)
+  instances = instances.values_list('id', 'offset', 'file_version_id',
+                                    'file_version__file_id')
+  instances = {instance_id: (offset, file_version_id, file_id)
+               for instance_id, offset, file_version_id, file_id in instances}
+
+  lookup_matches = []
+  for (source_id, _, target_id, target_instance_id, score,
+       match_type) in results:
+    offset, file_version_id, file_id = instances[target_instance_id]
+    lookup_matches.append({'type': match_type, 'score': score,
+                           'from_vector': source_id, 'to_vector': target_id,
+                           'to_instance': target_instance_id,
+                           'offset': offset, 'file_version': file_version_id,
+                           'file': file_id})
+  lookup_matches.sort(key=lambda lookup_match: -lookup_match['score'])
+  return lookup_matches
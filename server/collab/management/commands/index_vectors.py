@@ -0,0 +1,34 @@
+from django.core.management.base import BaseCommand
+
+from collab.models import Vector, HistogramBucket
+from collab import hist_index
+
+
+class Command(BaseCommand):
+  help = "Build histogram index buckets for vectors uploaded before indexing"
+
+  def add_arguments(self, parser):
+    parser.add_argument('--rebuild', action='store_true',
+                        help="Drop and rebuild the entire index, required "
+                             "after changing the index dimensions")
+    parser.add_argument('--batch-size', type=int, default=10000)
+
+  def handle(self, *args, **options):
+    if options['rebuild']:
+      HistogramBucket.objects.all().delete()
+
+    vectors = Vector.objects.filter(type__in=hist_index.INDEXED_TYPES,
+                                    packed__isnull=False, buckets__isnull=True)
+    vector_values = vectors.values_list('id', 'type', 'packed').order_by('id')
+
+    indexed, last_id = 0, 0
+    while True:
+      batch = vector_values.filter(id__gt=last_id)[:options['batch_size']]
+      batch = list(batch)
+      if not batch:
+        break
+      hist_index.index_vectors(batch)
+      indexed += len(batch)
+      last_id = batch[-1][0]
+
+    self.stdout.write("Indexed {} vectors".format(indexed))
@@ -0,0 +1,43 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from collab.models import Vector, HistogramBucket
+from collab import hist_index, matrix_cache, packing
+
+
+class Command(BaseCommand):
+  help = ("Convert vectors stored with textual data to their compact "
+          "representation, required for vectors uploaded before vectors were "
+          "packed on upload")
+
+  def add_arguments(self, parser):
+    parser.add_argument('--batch-size', type=int, default=1000)
+
+  def handle(self, *args, **options):
+    vectors = packing.get_unpacked(Vector.objects.all()).order_by('id')
+
+    packed, last_id = 0, 0
+    while True:
+      batch = list(vectors.filter(id__gt=last_id)[:options['batch_size']])
+      if not batch:
+        break
+
+      packing.pack_vectors(batch)
+      with transaction.atomic():
+        for vector in batch:
+          vector.save(update_fields=['data', 'digest_high', 'digest_low',
+                                     'packed'])
+
+        # histogram index buckets are keyed by mnemonic ids, re-index
+        batch_ids = [vector.id for vector in batch]
+        HistogramBucket.objects.filter(vector_id__in=batch_ids).delete()
+        hist_index.index_vectors((vector.id, vector.type, vector.packed)
+                                 for vector in batch)
+
+      for file_version_id in set(vector.file_version_id for vector in batch):
+        matrix_cache.invalidate(file_version_id)
+
+      packed += len(batch)
+      last_id = batch[-1].id
+
+    self.stdout.write("Packed {} vectors".format(packed))
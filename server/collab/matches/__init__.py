@@ -1,9 +1,11 @@
 from .assembly_hash import AssemblyHashMatch
 from .mnemonic_hash import MnemonicHashMatch
+from .identity_hash import IdentityHashMatch
 from .mnemonic_hist import MnemonicHistogramMatch
 
 
-match_list = [AssemblyHashMatch, MnemonicHashMatch, MnemonicHistogramMatch]
+match_list = [IdentityHashMatch, MnemonicHistogramMatch]
+match_types = {match.match_type: match for match in match_list}
 
-__all__ = ['AssemblyHashMatch', 'MnemonicHashMatch', 'MnemonicHistogramMatch',
-           'match_list']
+__all__ = ['AssemblyHashMatch', 'MnemonicHashMatch', 'IdentityHashMatch',
+           'MnemonicHistogramMatch', 'match_list', 'match_types']
@@ -1,20 +1,93 @@
 import collections
+
+from django.db import connection
+from django.db.models import Q
+
+from collab import models
 from . import match
 
 
 class HashMatch(match.Match):
+  method = 'identity'
+  resolves = True
+  in_database = True
+
+  fields = ('id', 'instance_id', 'type', 'digest_high', 'digest_low')
+  packed_field = 'digest_high'
+
+  @classmethod
+  def match(cls, source, target, **kwargs):
+    """Match vectors of identical digests. Vectors are keyed on both type and
+    digest, so all hash vector types of a match type are matched in a single
+    scan of the source and target vectors."""
+    del kwargs
+
+    source = cls.packed_vectors(source)
+    source_values = source.values_list(*cls.fields).iterator()
+    return cls.match_values(source_values, target)
+
+  @classmethod
+  def lookup(cls, vectors, target, **kwargs):
+    """Look target vectors up by the digests of vectors, using the (type,
+    digest) index instead of scanning all target vectors"""
+    del kwargs
+
+    vectors = [vector for vector in vectors
+               if vector.type in cls.get_vector_types()]
+    if not vectors:
+      return iter(())
+
+    digest_filter = Q()
+    for vector in vectors:
+      digest_filter |= Q(type=vector.type, digest_high=vector.digest_high,
+                         digest_low=vector.digest_low)
+    source_values = [(vector.id, vector.instance_id, vector.type,
+                      vector.digest_high, vector.digest_low)
+                     for vector in vectors]
+    return cls.match_values(source_values, target.filter(digest_filter))
+
+  @classmethod
+  def match_values(cls, source_values, target):
+    """Match an iterable of source (id, instance_id, type, digest_high,
+    digest_low) values against a target queryset"""
+    source_dict = collections.defaultdict(list)
+    for source_id, source_instance_id, vector_type, high, low in source_values:
+      source_key = (vector_type, high, low)
+      source_dict[source_key].append((source_id, source_instance_id))
+
+    # most target values won't be present in the source vectors, so target
+    # vectors are only used to probe the source dict and never stored
+    target = cls.packed_vectors(target)
+    target_values = target.values_list(*cls.fields).iterator()
+    for target_id, target_instance_id, vector_type, high, low in target_values:
+      source_matches = source_dict.get((vector_type, high, low), ())
+      for source_id, source_instance_id in source_matches:
+        yield (source_id, source_instance_id, target_id, target_instance_id,
+               100, vector_type)
+
   @classmethod
-  def match(cls, source, target):
-    # unique_values = set(source_dict.values())
-    flipped_rest = collections.defaultdict(list)
-    # TODO: could be optimized by enumerating all identity matchs together
-    target_values = target.values_list('id', 'instance_id', 'data').iterator()
-    for target_id, target_instance_id, target_data in target_values:
-      # TODO: could be optimized by uncommenting next line as most 'target'
-      # values won't be present in 'source' list
-      # if v in unique_values:
-      flipped_rest[target_data].append((target_id, target_instance_id))
-    source_values = source.values_list('id', 'instance_id', 'data').iterator()
-    for source_id, source_instance_id, source_data in source_values:
-      for target_id, target_instance_id in flipped_rest.get(source_data, ()):
-        yield source_id, source_instance_id, target_id, target_instance_id, 100
+  def match_in_db(cls, task_id, source, target):
+    """Insert a Match row for every pair of source and target vectors with
+    equal type and digest using a single INSERT ... SELECT statement, so
+    vectors are joined by the database and never transferred to the worker.
+    Returns the number of inserted matches."""
+    source = cls.packed_vectors(source)
+    target = cls.packed_vectors(target)
+    source_sql, source_params = \
+      source.values(*cls.fields).query.sql_with_params()
+    target_sql, target_params = \
+      target.values(*cls.fields).query.sql_with_params()
+
+    sql = ("INSERT INTO {match_table} (task_id, from_vector_id, to_vector_id, "
+           "from_instance_id, to_instance_id, type, score) "
+           "SELECT %s, s.id, t.id, s.instance_id, t.instance_id, s.type, 100 "
+           "FROM ({source_sql}) s JOIN ({target_sql}) t "
+           "ON s.type = t.type AND s.digest_high = t.digest_high "
+           "AND s.digest_low = t.digest_low")
+    sql = sql.format(match_table=models.Match._meta.db_table,
+                     source_sql=source_sql, target_sql=target_sql)
+    params = (task_id,) + source_params + target_params
+
+    with connection.cursor() as cursor:
+      cursor.execute(sql, params)
+      return cursor.rowcount
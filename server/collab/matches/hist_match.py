@@ -1,61 +1,255 @@
 import itertools
-import json
 import time
 
+from django.conf import settings
+
 import numpy as np
 import sklearn as skl
 import sklearn.metrics  # noqa flake8 importing as a different name
-import sklearn.preprocessing  # noqa flake8 importing as a different name
-import sklearn.feature_extraction  # noqa flake8 importing as a different name
 
+from collab import hist_index, matrix_cache, packing
 from . import match
 
 
 class HistogramMatch(match.Match):
-  @staticmethod
-  def match(source, target):
+  # whether vectors of this match type are kept in the histogram index and
+  # candidates should be looked up there instead of scoring every target
+  indexed = False
+  method = 'fuzzy'
+  supports_top_k = True
+  packed_field = 'packed'
+
+  # approximate bytes held per index candidate pair while scoring candidates,
+  # as a tuple in a set, in a list and in an array
+  candidate_pair_size = 256
+
+  # number of candidate vector ids queried at once, within sqlite's limit of
+  # 999 bound parameters per statement
+  candidate_batch_size = 500
+
+  @classmethod
+  def match(cls, source, target, top_k=None, min_score=None):
+    source = cls.packed_vectors(source)
+    source_values = source.values_list('id', 'instance_id', 'packed')
+    return cls.match_values(source_values, target, top_k=top_k,
+                            min_score=min_score)
+
+  @classmethod
+  def lookup(cls, vectors, target, top_k=None, min_score=None):
+    source_values = [(vector.id, vector.instance_id, vector.packed)
+                     for vector in vectors
+                     if vector.type in cls.get_vector_types()]
+    return cls.match_values(source_values, target, top_k=top_k,
+                            min_score=min_score)
+
+  @classmethod
+  def match_values(cls, source_values, target, top_k=None, min_score=None):
+    """Match a list of source (id, instance_id, packed) values against a
+    target queryset"""
+    source_values = list(source_values)
+    if not source_values:
+      return
+    source_ids, source_instance_ids, source_data = \
+      itertools.izip(*source_values)
+    target = cls.packed_vectors(target)
+
+    if cls.indexed and settings.HISTOGRAM_INDEX_ENABLED:
+      scores = cls.index_scores(source_data, target, top_k)
+    else:
+      scores = cls.target_scores(source_data, target, top_k)
+
+    for source_i, target_id, target_instance_id, score in scores:
+      if min_score is not None and score < min_score:
+        continue
+
+      yield (source_ids[source_i], source_instance_ids[source_i], target_id,
+             target_instance_id, score, cls.match_type)
+
+  @classmethod
+  def target_scores(cls, source_data, target, top_k):
+    """Yield (source index, target id, target instance id, score) of source
+    histograms against every target vector"""
     start = time.time()
-    source_values = itertools.izip(*source.values_list('id', 'instance_id',
-                                                       'data'))
-    target_values = itertools.izip(*target.values_list('id', 'instance_id',
-                                                       'data'))
-    print("izip time: {}".format(time.time() - start))
-
-    source_ids, source_instance_ids, source_data = source_values
-    target_ids, target_instance_ids, target_data = target_values
-    print("split time: {}".format(time.time() - start))
-
-    source_list = [json.loads(d) for d in source_data]
-    target_list = [json.loads(d) for d in target_data]
-    print("load time: {}".format(time.time() - start))
-    print("Source input sample:\t{}".format(source_list[:5]))
-    print("Source input sample:\t{}".format(target_list[:5]))
-
-    dictvect = skl.feature_extraction.DictVectorizer()
-    source_matrix = dictvect.fit_transform(source_list)
-    target_matrix = dictvect.transform(target_list)
+    source_matrix = matrix_cache.build_matrix(source_data)
+    target_ids, target_instance_ids, target_matrix = cls.load_targets(target)
+    if not len(target_ids):
+      return
+    source_matrix, target_matrix = matrix_cache.align(source_matrix,
+                                                      target_matrix)
     print("vectorization time: {}".format(time.time() - start))
     print("source matrix: {}, target matrix: {}".format(source_matrix.shape,
                                                         target_matrix.shape))
 
-    source_matrix = skl.preprocessing.normalize(source_matrix, norm='l2')
-    target_matrix = skl.preprocessing.normalize(target_matrix, norm='l2')
-    print("norm time: {}".format(time.time() - start))
+    if top_k:
+      scores = cls.top_k_scores(source_matrix, target_matrix, top_k)
+    else:
+      scores = cls.dense_scores(source_matrix, target_matrix)
+    for source_i, target_i, score in scores:
+      yield (source_i, target_ids[target_i], target_instance_ids[target_i],
+             score)
 
-    distance_matrix = skl.metrics.pairwise.euclidean_distances(source_matrix,
-                                                               target_matrix)
-    print("distance time: {}".format(time.time() - start))
-    print("min distance: {}, max distance: {}".format(distance_matrix.min(),
-                                                      distance_matrix.max()))
+  @classmethod
+  def index_scores(cls, source_data, target, top_k):
+    """Yield (source index, target id, target instance id, score) of source
+    histograms against their index candidates only.
 
-    for source_i, target_i in np.ndindex(*distance_matrix.shape):
-      source_id = source_ids[source_i]
-      source_instance_id = source_instance_ids[source_i]
+    Source histograms are handled in chunks, each querying the index and
+    loading its own candidate targets. As every source histogram has at most
+    HISTOGRAM_INDEX_BANDS * HISTOGRAM_INDEX_MAX_BUCKET_SIZE candidates,
+    chunks are sized so their candidate pairs fit in
+    HISTOGRAM_MATCH_MEMORY_BUDGET."""
+    source_candidates = settings.HISTOGRAM_INDEX_BANDS
+    source_candidates *= settings.HISTOGRAM_INDEX_MAX_BUCKET_SIZE
+    pair_size = max(source_candidates * cls.candidate_pair_size, 1)
+    chunk_size = max(settings.HISTOGRAM_MATCH_MEMORY_BUDGET // pair_size, 1)
 
-      target_id = target_ids[target_i]
-      target_instance_id = target_instance_ids[target_i]
+    for chunk_start in range(0, len(source_data), chunk_size):
+      start = time.time()
+      chunk_data = source_data[chunk_start:chunk_start + chunk_size]
+      source_list = [packing.hist_dict(d) for d in chunk_data]
+      candidates = hist_index.query(
+        source_list, target,
+        max_bucket_size=settings.HISTOGRAM_INDEX_MAX_BUCKET_SIZE)
+      print("index query time: {}, candidates: {}".format(time.time() - start,
+                                                          len(candidates)))
+      if not candidates:
+        continue
 
-      distance = distance_matrix[source_i][target_i]
-      score = (1 - distance) * 100
-      yield (source_id, source_instance_id, target_id, target_instance_id,
-             score)
+      target_ids, target_instance_ids, target_matrix = \
+        cls.load_candidates(target, candidates)
+      source_matrix, target_matrix = \
+        matrix_cache.align(matrix_cache.build_matrix(chunk_data),
+                           target_matrix)
+      target_indices = {target_id: target_i
+                        for target_i, target_id in enumerate(target_ids)}
+      candidate_pairs = [(source_i, target_indices[target_id])
+                         for source_i, target_id in candidates]
+      del candidates
+
+      scores = cls.candidate_scores(source_matrix, target_matrix,
+                                    candidate_pairs, top_k)
+      for source_i, target_i, score in scores:
+        yield (chunk_start + source_i, target_ids[target_i],
+               target_instance_ids[target_i], score)
+
+  @classmethod
+  def load_targets(cls, target):
+    """Return target vector ids, instance ids and prepared matrix of a target
+    queryset, from the matrix cache if enabled"""
+    if settings.HISTOGRAM_MATRIX_CACHE_DIR:
+      return matrix_cache.load_targets(target)
+    target_values = target.values_list('id', 'instance_id', 'packed')
+    return cls.read_targets(target_values.iterator())
+
+  @classmethod
+  def load_candidates(cls, target, candidates):
+    """Return target vector ids, instance ids and prepared matrix of only the
+    candidate vectors an index query returned. Candidates are always read from
+    the database, as the matrix cache would load the whole matrix of every
+    file version a candidate belongs to. Candidate ids are queried in batches
+    of candidate_batch_size, keeping every query within the database's limits
+    on bound parameters and statement size."""
+    candidate_ids = sorted(set(target_id for _, target_id in candidates))
+    batch_size = cls.candidate_batch_size
+    batches = (target.filter(id__in=candidate_ids[i:i + batch_size])
+                     .values_list('id', 'instance_id', 'packed')
+               for i in range(0, len(candidate_ids), batch_size))
+    return cls.read_targets(itertools.chain.from_iterable(batches))
+
+  @staticmethod
+  def read_targets(target_values):
+    """Return target vector ids, instance ids and prepared matrix of an
+    iterable of target (id, instance_id, packed) values"""
+    target_ids, target_instance_ids, target_data = [], [], []
+    for target_id, target_instance_id, packed in target_values:
+      target_ids.append(target_id)
+      target_instance_ids.append(target_instance_id)
+      target_data.append(packed)
+    return target_ids, target_instance_ids, \
+      matrix_cache.build_matrix(target_data)
+
+  @staticmethod
+  def candidate_scores(source_matrix, target_matrix, candidate_pairs, top_k):
+    """Yield the scores of the given source and target index pairs only,
+    keeping the top_k best scoring candidates of every source row if top_k is
+    set"""
+    pairs = np.array(sorted(candidate_pairs), dtype=np.int64).reshape(-1, 2)
+    pair_size = max(source_matrix.shape[1] * 24, 1)
+    chunk_size = max(settings.HISTOGRAM_MATCH_MEMORY_BUDGET // pair_size, 1)
+
+    similarities = np.empty(len(pairs))
+    for chunk_start in range(0, len(pairs), chunk_size):
+      chunk = pairs[chunk_start:chunk_start + chunk_size]
+      products = source_matrix[chunk[:, 0]]
+      products = products.multiply(target_matrix[chunk[:, 1]])
+      similarities[chunk_start:chunk_start + chunk_size] = \
+        np.asarray(products.sum(axis=1)).ravel()
+
+    # pairs are sorted by source, order each source's candidates by score
+    order = np.lexsort((-similarities, pairs[:, 0]))
+    distances = np.sqrt(np.maximum(2 - 2 * similarities, 0))
+
+    last_source_i, source_count = None, 0
+    for pair_i in order:
+      source_i, target_i = pairs[pair_i]
+      source_count = source_count + 1 if source_i == last_source_i else 1
+      last_source_i = source_i
+      if top_k and source_count > top_k:
+        continue
+      yield source_i, target_i, (1 - distances[pair_i]) * 100
+
+  @staticmethod
+  def dense_scores(source_matrix, target_matrix):
+    """Yield the score of every source and target pair, computing distances
+    one tile at a time so no more than HISTOGRAM_MATCH_MEMORY_BUDGET bytes of
+    distances are held at once."""
+    source_count, target_count = source_matrix.shape[0], target_matrix.shape[0]
+    cells = max(settings.HISTOGRAM_MATCH_MEMORY_BUDGET // 8, 1)
+    source_step = max(min(source_count, int(np.sqrt(cells))), 1)
+    target_step = max(min(target_count, cells // source_step), 1)
+    print("dense tile size: {}x{}".format(source_step, target_step))
+
+    for source_start in range(0, source_count, source_step):
+      source_tile = source_matrix[source_start:source_start + source_step]
+      for target_start in range(0, target_count, target_step):
+        target_tile = target_matrix[target_start:target_start + target_step]
+        distance_matrix = skl.metrics.pairwise.euclidean_distances(source_tile,
+                                                                   target_tile)
+
+        for tile_i, tile_j in np.ndindex(*distance_matrix.shape):
+          distance = distance_matrix[tile_i][tile_j]
+          yield (source_start + tile_i, target_start + tile_j,
+                 (1 - distance) * 100)
+
+  @staticmethod
+  def top_k_scores(source_matrix, target_matrix, top_k):
+    """Yield only the top_k best scoring targets of every source row.
+
+    Both matrices are L2 normalized, so a sparse dot product gives the cosine
+    similarity, from which the euclidean distance (and therefore the same
+    score the dense mode yields) is derived without ever materializing the
+    full source by target distance matrix. Source rows are handled in chunks
+    sized so a (possibly dense) similarity chunk, its values and indices,
+    fits in HISTOGRAM_MATCH_MEMORY_BUDGET."""
+    target_matrix_t = target_matrix.T.tocsc()
+    row_size = max(target_matrix.shape[0], 1) * 12
+    chunk_size = max(settings.HISTOGRAM_MATCH_MEMORY_BUDGET // row_size, 1)
+
+    for chunk_start in range(0, source_matrix.shape[0], chunk_size):
+      chunk_end = chunk_start + chunk_size
+      similarity = source_matrix[chunk_start:chunk_end].dot(target_matrix_t)
+      similarity = similarity.tocsr()
+
+      for chunk_i in range(similarity.shape[0]):
+        row_start, row_end = similarity.indptr[chunk_i:chunk_i + 2]
+        target_indices = similarity.indices[row_start:row_end]
+        similarities = similarity.data[row_start:row_end]
+
+        if len(similarities) > top_k:
+          best = np.argpartition(-similarities, top_k - 1)[:top_k]
+          target_indices = target_indices[best]
+          similarities = similarities[best]
+
+        distances = np.sqrt(np.maximum(2 - 2 * similarities, 0))
+        for target_i, distance in zip(target_indices, distances):
+          yield chunk_start + chunk_i, target_i, (1 - distance) * 100
@@ -0,0 +1,18 @@
+from . import hash_match
+from .assembly_hash import AssemblyHashMatch
+from .mnemonic_hash import MnemonicHashMatch
+
+
+class IdentityHashMatch(hash_match.HashMatch):
+  """Match all hash vector types together, matches are typed by the vector
+  type they were found for"""
+  match_type = 'identity_hash'
+  hash_matches = (AssemblyHashMatch, MnemonicHashMatch)
+
+  @classmethod
+  def get_vector_types(cls):
+    return tuple(match.vector_type for match in cls.hash_matches)
+
+  @classmethod
+  def get_match_types(cls):
+    return tuple(match.match_type for match in cls.hash_matches)
@@ -1,5 +1,58 @@
 class Match:
+  vector_type = None
+  match_type = None
+
+  # the task match method (see Task.METHOD_CHOICES) selecting this match type
+  method = None
+
+  # whether match_in_db is implemented, producing Match rows for a task
+  # entirely inside the database
+  in_database = False
+
+  # whether matches of this type are conclusive, so in cascade mode matched
+  # instances are not handed to any later match type
+  resolves = False
+
+  # whether the top_k match option is honored, in which case a task's matches
+  # of this type are merged down to a global top_k once all subtasks are done
+  supports_top_k = False
+
+  # field of the compact representation read by this match type. It is NULL
+  # for vectors stored before vectors were packed on upload, which are left
+  # out until converted by the pack_vectors command
+  packed_field = None
+
   @classmethod
-  def match(cls, source, target):
+  def packed_vectors(cls, vectors):
+    """Leave vectors without a compact representation out of a queryset"""
+    if cls.packed_field is None:
+      return vectors
+    return vectors.filter(**{cls.packed_field + '__isnull': False})
+
+  @classmethod
+  def get_vector_types(cls):
+    """Vector types read by this match type"""
+    return (cls.vector_type,)
+
+  @classmethod
+  def get_match_types(cls):
+    """Match types of the matches produced by this match type"""
+    return (cls.match_type,)
+
+  @classmethod
+  def match(cls, source, target, **kwargs):
     raise NotImplementedError("Method match for vector type {} not "
                               "implemented".format(cls))
+
+  @classmethod
+  def lookup(cls, vectors, target, **kwargs):
+    """Match a list of packed, possibly unsaved, Vector objects against a
+    target queryset, looking up only the targets they may match. Yields the
+    same match tuples match does, with None source ids for unsaved vectors."""
+    raise NotImplementedError("Method lookup for vector type {} not "
+                              "implemented".format(cls))
+
+  @classmethod
+  def match_in_db(cls, task_id, source, target):
+    raise NotImplementedError("Method match_in_db for vector type {} not "
+                              "implemented".format(cls))
@@ -0,0 +1,145 @@
+"""Prepared histogram matrices of file versions, cached on disk.
+
+A prepared matrix is the L2 normalized sparse matrix of all histogram vectors
+of a single vector type and type version in a file version, where columns are
+mnemonic ids, together with the vector and instance ids of its rows. Cached
+matrices are stored along with the number of vectors and the highest vector id
+they were built from, and are rebuilt once those no longer match the vectors
+in the database.
+"""
+
+import os
+import shutil
+import tempfile
+
+from django.conf import settings
+from django.db.models import Count, Max
+
+import numpy as np
+import scipy.sparse
+import sklearn as skl
+import sklearn.preprocessing  # noqa flake8 importing as a different name
+
+from collab.models import Vector
+from collab import packing
+
+
+def build_matrix(packed_list):
+  """Build an L2 normalized CSR matrix from a list of packed histograms"""
+  hists = [packing.unpack_hist(packed) for packed in packed_list]
+  indptr = np.zeros(len(hists) + 1, dtype=np.int64)
+  indptr[1:] = np.cumsum([len(hist) for hist in hists])
+  if hists:
+    hists = np.concatenate(hists)
+  else:
+    hists = np.zeros(0, dtype=packing.HIST_DTYPE)
+
+  # mnemonic ids start at 1, so a matrix of empty histograms has a single
+  # empty column
+  width = int(hists['id'].max()) + 1 if len(hists) else 1
+  matrix = scipy.sparse.csr_matrix((hists['count'].astype(np.float64),
+                                    hists['id'].astype(np.int64), indptr),
+                                   shape=(len(indptr) - 1, width))
+  if not matrix.shape[0]:
+    return matrix
+  return skl.preprocessing.normalize(matrix, norm='l2')
+
+
+def align(*matrices):
+  """Widen CSR matrices to the same number of columns"""
+  width = max(matrix.shape[1] for matrix in matrices)
+  return [scipy.sparse.csr_matrix((matrix.data, matrix.indices,
+                                   matrix.indptr),
+                                  shape=(matrix.shape[0], width))
+          for matrix in matrices]
+
+
+def get_path(file_version_id, vector_type, type_version):
+  return os.path.join(settings.HISTOGRAM_MATRIX_CACHE_DIR,
+                      str(file_version_id),
+                      "{}-{}.npz".format(vector_type, type_version))
+
+
+def load(file_version_id, vector_type, type_version):
+  """Return vector ids, instance ids and prepared matrix of a file version,
+  either from cache or by building and caching it"""
+  vectors = Vector.objects.filter(file_version_id=file_version_id,
+                                  type=vector_type, type_version=type_version,
+                                  packed__isnull=False)
+  fingerprint = vectors.aggregate(Count('id'), Max('id'))
+  fingerprint = [fingerprint['id__count'], fingerprint['id__max']]
+
+  path = get_path(file_version_id, vector_type, type_version)
+  if os.path.isfile(path):
+    with np.load(path) as cached:
+      if cached['fingerprint'].tolist() == fingerprint:
+        matrix = scipy.sparse.csr_matrix((cached['data'], cached['indices'],
+                                          cached['indptr']),
+                                         shape=tuple(cached['shape']))
+        return cached['ids'], cached['instance_ids'], matrix
+
+  vector_values = vectors.order_by('id').values_list('id', 'instance_id',
+                                                     'packed')
+  ids, instance_ids, packed_list = [], [], []
+  for vector_id, instance_id, packed in vector_values.iterator():
+    ids.append(vector_id)
+    instance_ids.append(instance_id)
+    packed_list.append(packed)
+  ids = np.array(ids, dtype=np.int64)
+  instance_ids = np.array(instance_ids, dtype=np.int64)
+  matrix = build_matrix(packed_list)
+
+  save(path, fingerprint=fingerprint, ids=ids, instance_ids=instance_ids,
+       data=matrix.data, indices=matrix.indices, indptr=matrix.indptr,
+       shape=matrix.shape)
+  return ids, instance_ids, matrix
+
+
+def save(path, **arrays):
+  """Atomically write arrays to path, so concurrent readers never see a
+  partially written file"""
+  dir_path = os.path.dirname(path)
+  if not os.path.isdir(dir_path):
+    try:
+      os.makedirs(dir_path)
+    except OSError:
+      # created concurrently
+      if not os.path.isdir(dir_path):
+        raise
+
+  fd, temp_path = tempfile.mkstemp(dir=dir_path, suffix='.npz')
+  with os.fdopen(fd, 'wb') as fh:
+    np.savez(fh, **arrays)
+  os.rename(temp_path, path)
+
+
+def load_targets(target):
+  """Return vector ids, instance ids and prepared matrix of a target vector
+  queryset by stacking the cached matrices of its file versions"""
+  blocks = target.values_list('file_version_id', 'type', 'type_version')
+  blocks = blocks.distinct().order_by('file_version_id', 'type',
+                                      'type_version')
+  blocks = [load(*block) for block in blocks]
+  if not blocks:
+    return [], [], build_matrix([])
+
+  ids = np.concatenate([block_ids for block_ids, _, _ in blocks])
+  instance_ids = np.concatenate([block_instance_ids
+                                 for _, block_instance_ids, _ in blocks])
+  matrix = scipy.sparse.vstack(align(*[block_matrix
+                                       for _, _, block_matrix in blocks]),
+                               format='csr')
+
+  # cached blocks hold entire file versions, keep only rows of the queryset
+  mask = np.in1d(ids, list(target.values_list('id', flat=True)))
+  if not mask.all():
+    ids, instance_ids, matrix = ids[mask], instance_ids[mask], matrix[mask]
+  return ids.tolist(), instance_ids.tolist(), matrix
+
+
+def invalidate(file_version_id):
+  """Remove all cached matrices of a file version"""
+  if not settings.HISTOGRAM_MATRIX_CACHE_DIR:
+    return
+  shutil.rmtree(os.path.join(settings.HISTOGRAM_MATRIX_CACHE_DIR,
+                             str(file_version_id)), ignore_errors=True)
@@ -0,0 +1,40 @@
+import io
+
+from django.conf import settings
+from django.http import JsonResponse
+
+from collab import streaming
+
+
+class GzipRequestMiddleware(object):
+  """Transparently decompress gzip compressed request bodies.
+
+  Bodies of streamed content types are decompressed as they are read, a line
+  at a time of at most REQUEST_STREAM_MAX_LINE_SIZE bytes, and their content
+  length is dropped as it is not known up front. Other bodies are
+  decompressed right away, up to DATA_UPLOAD_MAX_MEMORY_SIZE bytes, and their
+  content length is replaced by the decompressed length.
+  """
+  streamed_content_types = ('application/x-ndjson',)
+
+  def process_request(self, request):
+    encoding = request.META.get('HTTP_CONTENT_ENCODING', '')
+    if encoding.strip().lower() != 'gzip':
+      return None
+    del request.META['HTTP_CONTENT_ENCODING']
+
+    content_type = request.META.get('CONTENT_TYPE', '').split(';')[0]
+    if content_type.strip().lower() in self.streamed_content_types:
+      request._stream = streaming.GzipStream(
+        request._stream, max_line=settings.REQUEST_STREAM_MAX_LINE_SIZE)
+      request.META.pop('CONTENT_LENGTH', None)
+      return None
+
+    max_size = getattr(settings, 'DATA_UPLOAD_MAX_MEMORY_SIZE', None)
+    try:
+      body = streaming.GzipStream(request._stream, max_size=max_size).read()
+    except streaming.GzipError as ex:
+      return JsonResponse({'detail': str(ex)}, status=400)
+    request._stream = io.BytesIO(body)
+    request.META['CONTENT_LENGTH'] = str(len(body))
+    return None
@@ -87,11 +87,20 @@ class Vector(models.Model):
   file_version = models.ForeignKey(FileVersion, related_name='vectors')
   type = models.CharField(max_length=16, choices=TYPE_CHOICES)
   type_version = models.IntegerField()
-  data = models.TextField()
+  # textual data is only kept when it can not be reproduced from the compact
+  # representation; a digest for hash vectors and a packed array of
+  # (mnemonic id, count) pairs for histogram vectors
+  data = models.TextField(blank=True)
+  digest_high = models.BigIntegerField(null=True)
+  digest_low = models.BigIntegerField(null=True)
+  packed = models.BinaryField(null=True)
 
   matches = models.ManyToManyField('self', symmetrical=False, through='Match',
                                    related_name='related_to+')
 
+  class Meta:
+    index_together = (('type', 'digest_high', 'digest_low'),)
+
   def __unicode__(self):
     return "{} vector version {} for {}".format(self.get_type_display(),
                                                 self.type_version,
@@ -99,6 +108,27 @@ class Vector(models.Model):
   __str__ = __unicode__
 
 
+class Mnemonic(models.Model):
+  name = models.CharField(max_length=128)
+  type_version = models.IntegerField(default=0)
+
+  class Meta:
+    unique_together = (('type_version', 'name'),)
+
+  def __unicode__(self):
+    return "Mnemonic {} (version {})".format(self.name, self.type_version)
+  __str__ = __unicode__
+
+
+class HistogramBucket(models.Model):
+  vector = models.ForeignKey(Vector, related_name='buckets')
+  band = models.PositiveSmallIntegerField()
+  key = models.BigIntegerField()
+
+  class Meta:
+    index_together = (('band', 'key'),)
+
+
 class Task(models.Model):
   STATUS_PENDING = 'pending'
   STATUS_STARTED = 'started'
@@ -108,6 +138,16 @@ class Task(models.Model):
                     (STATUS_STARTED, "Started"),
                     (STATUS_DONE, "Done!"),
                     (STATUS_FAILED, "Failure"))
+  METHOD_IDENTITY = 'identity'
+  METHOD_FUZZY = 'fuzzy'
+  METHOD_GRAPH = 'graph'
+  METHOD_CHOICES = ((METHOD_IDENTITY, "Identity matches"),
+                    (METHOD_FUZZY, "Fuzzy matches"),
+                    (METHOD_GRAPH, "Graph matches"))
+  QUEUE_INTERACTIVE = 'interactive'
+  QUEUE_BULK = 'bulk'
+  QUEUE_CHOICES = ((QUEUE_INTERACTIVE, "Interactive"),
+                   (QUEUE_BULK, "Bulk"))
 
   task_id = models.UUIDField(db_index=True, null=True, unique=True,
                              editable=False)
@@ -129,9 +169,56 @@ class Task(models.Model):
   target_file = models.ForeignKey(File, null=True)
   target_project = models.ForeignKey(Project, null=True)
 
+  # optional fuzzy match limits, keeping only the top_k best matches of every
+  # source function and dropping matches scored below min_score
+  top_k = models.PositiveIntegerField(null=True)
+  min_score = models.FloatField(null=True)
+
+  # comma separated list of requested match methods, only match types of
+  # those methods are run
+  methods = models.CharField(max_length=64,
+                             default=','.join(method
+                                              for method, _ in METHOD_CHOICES))
+
+  # in cascade mode match types run one after the other, and source instances
+  # (and optionally target instances) matched by a conclusive match type are
+  # left out of all later match types
+  cascade = models.BooleanField(default=False)
+  cascade_targets = models.BooleanField(default=False)
+
+  # digest of the target vectors matched by the task, used to reuse the
+  # results of an equivalent task while its targets are unchanged
+  target_digest = models.CharField(max_length=32, null=True, db_index=True,
+                                   editable=False)
+
+  # celery queue all work of the task is sent to, chosen by estimated size
+  queue = models.CharField(default=QUEUE_BULK, max_length=16,
+                           choices=QUEUE_CHOICES, editable=False)
+
+  # target file versions matched by the task so far, later file versions and
+  # vectors added to covered file versions are matched by incremental runs
+  covered_file_versions = models.ManyToManyField(FileVersion, blank=True,
+                                                 through='TaskCoverage',
+                                                 related_name='covering_tasks')
+
   progress = models.PositiveSmallIntegerField(default=0)
   progress_max = models.PositiveSmallIntegerField(null=True)
 
+  def get_methods(self):
+    return self.methods.split(',') if self.methods else []
+
+
+class TaskCoverage(models.Model):
+  """A target file version matched by a task, with the number of vectors and
+  the highest vector id it had when matched"""
+  task = models.ForeignKey(Task, related_name='coverages')
+  file_version = models.ForeignKey(FileVersion, related_name='coverages')
+  vector_count = models.PositiveIntegerField()
+  max_vector_id = models.IntegerField()
+
+  class Meta:
+    unique_together = (('task', 'file_version'),)
+
 
 class Match(models.Model):
   from_vector = models.ForeignKey(Vector, related_name='from_vector')
@@ -145,6 +232,23 @@ class Match(models.Model):
   type = models.CharField(max_length=16, choices=Vector.TYPE_CHOICES)
   score = models.FloatField()
 
+  class Meta:
+    # matches are listed by task and descending score
+    index_together = (('task', 'score', 'id'),)
+
+
+class BestMatch(models.Model):
+  """The best scoring match of every source instance and match type of a
+  task, filled in once the task is done"""
+  task = models.ForeignKey(Task, related_name='best_matches')
+  from_instance = models.ForeignKey(Instance, related_name='+')
+  to_instance = models.ForeignKey(Instance, related_name='+')
+  type = models.CharField(max_length=16, choices=Vector.TYPE_CHOICES)
+  score = models.FloatField()
+
+  class Meta:
+    index_together = (('task', 'from_instance'),)
+
 
 class Annotation(models.Model):
   TYPE_NAME = 'name'
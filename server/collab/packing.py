@@ -0,0 +1,188 @@
+"""Conversion between the textual vector data format used by the API and the
+compact representation vectors are stored and matched in.
+
+Hash vectors are stored as a pair of signed 64 bit integers holding the 16
+bytes of the digest, and histogram vectors as a packed array of
+(mnemonic id, count) pairs, sorted by mnemonic id.
+
+Mnemonic ids come from a single server wide vocabulary that only ever grows,
+so an id means the same mnemonic in every vector, task and cached matrix.
+Mnemonics are kept per vector type version, so histograms of different type
+versions never share a column.
+"""
+
+import binascii
+import collections
+import hashlib
+import json
+import string
+import struct
+
+from django.db import IntegrityError, transaction
+from django.utils import six
+
+import numpy as np
+
+from collab.models import Vector, Mnemonic
+
+
+HASH_TYPES = (Vector.TYPE_ASSEMBLY_HASH, Vector.TYPE_MNEMONIC_HASH)
+HIST_TYPES = (Vector.TYPE_MNEMONIC_HIST,)
+
+HIST_DTYPE = np.dtype([('id', '<u4'), ('count', '<u4')])
+
+# mnemonic ids never change once assigned, so they're cached for the lifetime
+# of the process, keyed by (type_version, name). Ids are only cached once the
+# transaction they were read or created in commits, as a rolled back mnemonic
+# id may later be assigned to another mnemonic.
+_mnemonic_ids = {}
+
+
+def is_digest(data):
+  return len(data) == 32 and all(c in string.hexdigits for c in data)
+
+
+def pack_digest(data):
+  """Return a (high, low) integer pair for a hex digest. Data which is not a
+  hex digest is hashed, and has to be kept as text to be unpacked."""
+  if is_digest(data):
+    digest = binascii.unhexlify(data)
+  else:
+    digest = hashlib.md5(data.encode('utf-8')).digest()
+  return struct.unpack('>qq', digest)
+
+
+def unpack_digest(high, low):
+  return binascii.hexlify(struct.pack('>qq', high, low)).decode('ascii')
+
+
+def validate(vector_type, data):
+  """Raise a ValueError if data can not be packed as a vector of vector_type"""
+  if vector_type in HIST_TYPES:
+    hist = json.loads(data)
+    if not isinstance(hist, dict):
+      raise ValueError("Histogram vector data must be a JSON object")
+    for count in hist.values():
+      if not isinstance(count, six.integer_types) or count < 0:
+        raise ValueError("Histogram counts must be non-negative integers")
+
+
+def get_mnemonic_ids(names, type_version, create=True):
+  """Return a dict mapping each of names to its mnemonic id in the vocabulary
+  of type_version, adding any mnemonics not yet in the vocabulary. If create
+  is not set, mnemonics not in the vocabulary are left out instead."""
+  names = set(names)
+  mnemonic_ids = {name: _mnemonic_ids[type_version, name] for name in names
+                  if (type_version, name) in _mnemonic_ids}
+
+  missing = names.difference(mnemonic_ids)
+  if missing:
+    mnemonics = Mnemonic.objects.filter(type_version=type_version,
+                                        name__in=missing)
+    mnemonic_ids.update(mnemonics.values_list('name', 'id'))
+
+  if not create:
+    return mnemonic_ids
+
+  for name in names.difference(mnemonic_ids):
+    try:
+      with transaction.atomic():
+        mnemonic = Mnemonic.objects.create(name=name,
+                                           type_version=type_version)
+    except IntegrityError:
+      # added concurrently by another request
+      mnemonic = Mnemonic.objects.get(name=name, type_version=type_version)
+    mnemonic_ids[name] = mnemonic.id
+
+  if missing:
+    new_ids = {(type_version, name): mnemonic_ids[name] for name in missing}
+    transaction.on_commit(lambda: _mnemonic_ids.update(new_ids))
+  return mnemonic_ids
+
+
+def pack_vectors(vectors, create_mnemonics=True):
+  """Fill in the compact representation of a list of unsaved Vector objects
+  from their textual data. The textual data is cleared unless it is needed to
+  reproduce it. Mnemonics of all histogram vectors of the same type version
+  are looked up together. If create_mnemonics is not set, nothing is written
+  to the database and mnemonics not in the vocabulary are left out of
+  histograms, which is only suitable for vectors that are never stored."""
+  hists = {}
+  version_names = collections.defaultdict(set)
+  for vector_i, vector in enumerate(vectors):
+    if vector.type in HIST_TYPES:
+      hists[vector_i] = json.loads(vector.data)
+      version_names[vector.type_version].update(hists[vector_i])
+  mnemonic_ids = {type_version: get_mnemonic_ids(names, type_version,
+                                                 create_mnemonics)
+                  for type_version, names in version_names.items()}
+
+  for vector_i, vector in enumerate(vectors):
+    if vector.type in HASH_TYPES:
+      vector.digest_high, vector.digest_low = pack_digest(vector.data)
+      if is_digest(vector.data):
+        vector.data = ''
+    elif vector_i in hists:
+      version_ids = mnemonic_ids[vector.type_version]
+      hist = sorted((version_ids[name], count)
+                    for name, count in hists[vector_i].items()
+                    if name in version_ids)
+      vector.packed = np.array(hist, dtype=HIST_DTYPE).tobytes()
+      vector.data = ''
+
+
+def get_unpacked(vectors):
+  """Return the vectors of a queryset stored before vectors were packed on
+  upload, which have no compact representation and are not matched until
+  converted by the pack_vectors command"""
+  return vectors.filter(type__in=HASH_TYPES + HIST_TYPES,
+                        digest_high__isnull=True, packed__isnull=True)
+
+
+def get_packed(vectors):
+  """Return the vectors of a queryset which can be matched, leaving out the
+  vectors get_unpacked returns"""
+  return vectors.exclude(type__in=HASH_TYPES + HIST_TYPES,
+                         digest_high__isnull=True, packed__isnull=True)
+
+
+def unpack_hist(packed):
+  """Return a structured array of (id, count) pairs of a packed histogram"""
+  return np.frombuffer(packed, dtype=HIST_DTYPE)
+
+
+def hist_dict(packed):
+  """Return a {mnemonic id: count} dict of a packed histogram"""
+  hist = unpack_hist(packed)
+  return dict(zip(hist['id'].tolist(), hist['count'].tolist()))
+
+
+def get_mnemonic_names(packed_list):
+  """Return a dict mapping mnemonic ids to names for all mnemonics of an
+  iterable of packed histograms, in a single query"""
+  mnemonic_ids = set()
+  for packed in packed_list:
+    mnemonic_ids.update(unpack_hist(packed)['id'].tolist())
+  if not mnemonic_ids:
+    return {}
+  return dict(Mnemonic.objects.filter(id__in=mnemonic_ids)
+                              .values_list('id', 'name'))
+
+
+def unpack_data(vector, mnemonic_names=None):
+  """Return the textual data of a Vector object. Mnemonic names are looked up
+  in mnemonic_names if given, and queried otherwise."""
+  if vector.data:
+    return vector.data
+  if vector.type in HASH_TYPES and vector.digest_high is not None:
+    return unpack_digest(vector.digest_high, vector.digest_low)
+  if vector.type in HIST_TYPES and vector.packed is not None:
+    hist = unpack_hist(vector.packed)
+    names = mnemonic_names
+    if names is None or not all(mnemonic_id in names
+                                for mnemonic_id in hist['id'].tolist()):
+      names = dict(Mnemonic.objects.filter(id__in=hist['id'].tolist())
+                                   .values_list('id', 'name'))
+    return json.dumps({names[mnemonic_id]: count
+                       for mnemonic_id, count in hist.tolist()})
+  return vector.data
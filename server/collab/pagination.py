@@ -0,0 +1,76 @@
+import base64
+import binascii
+import collections
+import json
+
+from django.conf import settings
+from django.db.models import Q
+from rest_framework import exceptions, pagination, response
+from rest_framework.utils.urls import replace_query_param
+
+
+class MatchKeysetPagination(pagination.BasePagination):
+  """Keyset pagination of matches ordered by descending task, score and id.
+  Every page starts right after the (task, score, id) key of the last match
+  of the previous page, so reaching a page deep into a large task costs no
+  more than reaching the first one, unlike offset based pagination. All keys
+  are descending, so the (task, score, id) index is scanned backwards instead
+  of sorting a task's matches for every page."""
+  cursor_query_param = 'cursor'
+  page_size_query_param = 'page_size'
+  ordering = ('-task', '-score', '-id')
+
+  def __init__(self):
+    self.request = None
+    self.next_key = None
+
+  def paginate_queryset(self, queryset, request, view=None):
+    del view
+    self.request = request
+
+    key = self.decode_cursor(request)
+    if key is not None:
+      task_id, score, match_id = key
+      after_key = Q(task_id__lt=task_id)
+      after_key |= Q(task_id=task_id, score__lt=score)
+      after_key |= Q(task_id=task_id, score=score, id__lt=match_id)
+      queryset = queryset.filter(after_key)
+
+    page_size = self.get_page_size(request)
+    page = list(queryset.order_by(*self.ordering)[:page_size + 1])
+    if len(page) > page_size:
+      page = page[:page_size]
+      self.next_key = [page[-1].task_id, page[-1].score, page[-1].id]
+    return page
+
+  def get_paginated_response(self, data):
+    return response.Response(collections.OrderedDict([
+      ('next', self.get_next_link()),
+      ('results', data)]))
+
+  def get_page_size(self, request):
+    try:
+      page_size = int(request.query_params[self.page_size_query_param])
+    except (KeyError, ValueError):
+      return settings.MATCH_PAGE_SIZE
+    return min(max(page_size, 1), settings.MATCH_MAX_PAGE_SIZE)
+
+  def decode_cursor(self, request):
+    encoded = request.query_params.get(self.cursor_query_param)
+    if not encoded:
+      return None
+
+    try:
+      task_id, score, match_id = json.loads(
+        base64.urlsafe_b64decode(encoded.encode('ascii')).decode('ascii'))
+      return int(task_id), float(score), int(match_id)
+    except (TypeError, ValueError, UnicodeError, binascii.Error):
+      raise exceptions.NotFound("Invalid cursor")
+
+  def get_next_link(self):
+    if self.next_key is None:
+      return None
+    encoded = json.dumps(self.next_key).encode('ascii')
+    encoded = base64.urlsafe_b64encode(encoded).decode('ascii')
+    return replace_query_param(self.request.build_absolute_uri(),
+                               self.cursor_query_param, encoded)
@@ -1,4 +1,8 @@
+from django.db import transaction
+from django.db.models import Max
+from django.utils import six
 from rest_framework import serializers
+from collab import hist_index, matrix_cache, packing
 from collab.models import (Project, File, FileVersion, Task, Instance, Vector,
                            Annotation, Match)
 
@@ -29,6 +33,21 @@ class FileVersionSerializer(serializers.ModelSerializer):
     fields = ('id', 'created', 'file', 'md5hash')
 
 
+class MethodsField(serializers.MultipleChoiceField):
+  """Task match methods, a list of method names stored comma separated"""
+  def __init__(self, **kwargs):
+    kwargs['choices'] = Task.METHOD_CHOICES
+    super(MethodsField, self).__init__(**kwargs)
+
+  def to_internal_value(self, data):
+    methods = super(MethodsField, self).to_internal_value(data)
+    return ','.join(method for method, _ in Task.METHOD_CHOICES
+                    if method in methods)
+
+  def to_representation(self, value):
+    return [method for method in value.split(',') if method]
+
+
 class TaskSerializer(serializers.ModelSerializer):
   owner = serializers.ReadOnlyField(source='owner.username')
   source_file = serializers.ReadOnlyField(source='source_file_version.file_id')
@@ -38,13 +57,15 @@ class TaskSerializer(serializers.ModelSerializer):
   status = serializers.ReadOnlyField()
   progress = serializers.ReadOnlyField()
   progress_max = serializers.ReadOnlyField()
+  methods = MethodsField(required=False)
 
   class Meta:
     model = Task
     fields = ('id', 'task_id', 'created', 'finished', 'owner', 'status',
               'target_project', 'target_file', 'source_file',
-              'source_file_version', 'source_start', 'source_end', 'progress',
-              'progress_max')
+              'source_file_version', 'source_start', 'source_end', 'top_k',
+              'min_score', 'methods', 'cascade', 'cascade_targets',
+              'progress', 'progress_max')
 
 
 class TaskEditSerializer(TaskSerializer):
@@ -54,10 +75,80 @@ class TaskEditSerializer(TaskSerializer):
   source_file_version = serializers.ReadOnlyField()
   source_start = serializers.ReadOnlyField()
   source_end = serializers.ReadOnlyField()
+  top_k = serializers.ReadOnlyField()
+  min_score = serializers.ReadOnlyField()
+  methods = MethodsField(read_only=True)
+  cascade = serializers.ReadOnlyField()
+  cascade_targets = serializers.ReadOnlyField()
+
+
+class VectorDataField(serializers.Field):
+  """Vector data in its textual format, hex digests for hash vectors and JSON
+  objects for histogram vectors, which is packed on creation and unpacked on
+  representation"""
+  def __init__(self, **kwargs):
+    kwargs['source'] = '*'
+    super(VectorDataField, self).__init__(**kwargs)
+
+  def to_internal_value(self, data):
+    if not isinstance(data, six.string_types):
+      raise serializers.ValidationError("Vector data must be a string")
+    return {'data': data}
+
+  def to_representation(self, value):
+    return packing.unpack_data(value, self.context.get('mnemonic_names'))
+
+
+class CachedPrimaryKeyRelatedField(serializers.PrimaryKeyRelatedField):
+  """Primary key related field looking every object up only once, so a batch
+  of items referring to the same few objects doesn't repeat the lookup for
+  every item"""
+  def __init__(self, **kwargs):
+    super(CachedPrimaryKeyRelatedField, self).__init__(**kwargs)
+    self.objects = {}
+
+  def to_internal_value(self, data):
+    key = six.text_type(data)
+    if key not in self.objects:
+      self.objects[key] = \
+        super(CachedPrimaryKeyRelatedField, self).to_internal_value(data)
+    return self.objects[key]
+
+
+class BaseVectorSerializer(serializers.ModelSerializer):
+  data = VectorDataField()
+
+  def validate(self, attrs):
+    # a partial update only has the vector data validated if the data or the
+    # type it is interpreted as changes, with the other taken from the vector
+    if 'type' not in attrs and 'data' not in attrs:
+      return attrs
+    vector_type = attrs.get('type') or self.instance.type
+    data = attrs['data'] if 'data' in attrs else \
+      packing.unpack_data(self.instance)
+    try:
+      packing.validate(vector_type, data)
+    except ValueError as ex:
+      raise serializers.ValidationError({'data': [str(ex)]})
+    return attrs
+
+
+class InstanceListSerializer(serializers.ListSerializer):
+  """Creates a batch of instances along with all their vectors and annotations
+  in a few set-based statements, instead of several statements per instance"""
+  def create(self, validated_data):
+    instances = create_instances(validated_data)
+
+    # all mnemonic names of histogram vectors are looked up at once
+    self.context['mnemonic_names'] = packing.get_mnemonic_names(
+      vector.packed for instance in instances
+      for vector in instance.vectors.all()
+      if vector.type in packing.HIST_TYPES)
+    return instances
 
 
 class InstanceSerializer(serializers.ModelSerializer):
-  class NestedVectorSerializer(serializers.ModelSerializer):
+  class NestedVectorSerializer(BaseVectorSerializer):
     class Meta:
       model = Vector
       fields = ('id', 'type', 'type_version', 'data')
@@ -69,6 +160,8 @@ class InstanceSerializer(serializers.ModelSerializer):
 
   owner = serializers.ReadOnlyField(source='owner.username')
   file = serializers.ReadOnlyField(source='file_version.file_id')
+  file_version = CachedPrimaryKeyRelatedField(
+    queryset=FileVersion.objects.select_related('file'))
   vectors = NestedVectorSerializer(many=True, required=True)
   annotations = NestedAnnotationSerializer(many=True, required=True)
 
@@ -76,24 +169,97 @@ class InstanceSerializer(serializers.ModelSerializer):
     model = Instance
     fields = ('id', 'owner', 'file', 'file_version', 'type', 'offset',
               'vectors', 'annotations')
+    list_serializer_class = InstanceListSerializer
 
   def create(self, validated_data):
-    vectors_data = validated_data.pop('vectors')
-    annotations_data = validated_data.pop('annotations')
-    file_version = validated_data['file_version']
-
-    obj = self.Meta.model.objects.create(**validated_data)
-    vectors = (Vector(instance=obj, file_version=file_version,
-                      file=file_version.file, **vector_data)
-               for vector_data in vectors_data)
-    Vector.objects.bulk_create(vectors)
-    annotations = (Annotation(instance=obj, **annotation_data)
-                   for annotation_data in annotations_data)
-    Annotation.objects.bulk_create(annotations)
-    return obj
+    return create_instances([validated_data])[0]
+
+
+@transaction.atomic
+def create_instances(instances_data):
+  """Create instances, and their vectors and annotations, from a list of
+  validated instance data. Instances are returned in order, with their vectors
+  and annotations prefetched."""
+  instances_data = [dict(instance_data) for instance_data in instances_data]
+  vectors_data = [instance_data.pop('vectors')
+                  for instance_data in instances_data]
+  annotations_data = [instance_data.pop('annotations')
+                      for instance_data in instances_data]
 
+  instances = [Instance(**instance_data) for instance_data in instances_data]
+  Instance.objects.bulk_create(instances)
+  fill_instance_ids(instances)
 
-class VectorSerializer(serializers.ModelSerializer):
+  vectors = [Vector(instance_id=instance.id,
+                    file_version_id=instance.file_version_id,
+                    file_id=instance.file_version.file_id, **vector_data)
+             for instance, instance_vectors in zip(instances, vectors_data)
+             for vector_data in instance_vectors]
+  packing.pack_vectors(vectors)
+  Vector.objects.bulk_create(vectors)
+
+  instance_ids = [instance.id for instance in instances]
+  indexed_vectors = Vector.objects.filter(instance_id__in=instance_ids,
+                                          type__in=hist_index.INDEXED_TYPES)
+  indexed_vectors = indexed_vectors.values_list('id', 'type', 'packed')
+  hist_index.index_vectors(indexed_vectors)
+  for file_version_id in set(instance.file_version_id
+                             for instance in instances):
+    matrix_cache.invalidate(file_version_id)
+
+  annotations = [Annotation(instance_id=instance.id, **annotation_data)
+                 for instance, instance_annotations in zip(instances,
+                                                           annotations_data)
+                 for annotation_data in instance_annotations]
+  Annotation.objects.bulk_create(annotations)
+
+  created = Instance.objects.filter(id__in=instance_ids)
+  created = created.select_related('owner', 'file_version')
+  created = created.prefetch_related('vectors', 'annotations')
+  created = {instance.id: instance for instance in created}
+  return [created[instance_id] for instance_id in instance_ids]
+
+
+def exclude_uploaded(instances_data):
+  """Return a list of validated instance data without the instances already
+  uploaded, or repeated earlier in the list. Instances are identified by file
+  version and offset, so retrying an upload which was partially or completely
+  stored doesn't duplicate its instances."""
+  keys = [(instance_data['file_version'].id, instance_data['offset'])
+          for instance_data in instances_data]
+  uploaded = Instance.objects.filter(
+    file_version_id__in=set(file_version_id for file_version_id, _ in keys),
+    offset__in=set(offset for _, offset in keys))
+  uploaded = set(uploaded.values_list('file_version_id', 'offset'))
+
+  new_instances_data = []
+  for key, instance_data in zip(keys, instances_data):
+    if key not in uploaded:
+      uploaded.add(key)
+      new_instances_data.append(instance_data)
+  return new_instances_data
+
+
+def fill_instance_ids(instances):
+  """Set the ids of bulk created instances. Only some database backends return
+  ids of bulk inserted rows, on other backends ids are looked up by file
+  version and offset, which identify a single instance of an upload."""
+  missing = [instance for instance in instances if instance.id is None]
+  if not missing:
+    return
+
+  created = Instance.objects.filter(
+    file_version_id__in=set(instance.file_version_id for instance in missing),
+    offset__in=set(instance.offset for instance in missing))
+  created = created.values_list('file_version_id', 'offset')
+  created = dict(((file_version_id, offset), instance_id)
+                 for file_version_id, offset, instance_id
+                 in created.annotate(Max('id')))
+  for instance in missing:
+    instance.id = created[instance.file_version_id, instance.offset]
+
+
+class VectorSerializer(BaseVectorSerializer):
   file = serializers.ReadOnlyField(source='file_version.file_id')
 
   class Meta:
@@ -103,10 +269,68 @@ class VectorSerializer(serializers.ModelSerializer):
 
   def create(self, validated_data):
     file = validated_data['file_version'].file
-    return self.Meta.model.objects.create(file=file, **validated_data)
+    obj = self.Meta.model(file=file, **validated_data)
+    packing.pack_vectors([obj])
+    obj.save()
+    hist_index.index_vectors([(obj.id, obj.type, obj.packed)])
+    matrix_cache.invalidate(obj.file_version_id)
+    return obj
+
+  def update(self, instance, validated_data):
+    old_file_version_id = instance.file_version_id
+    repack = any(attr in validated_data
+                 for attr in ('type', 'type_version', 'data'))
+    if repack and 'data' not in validated_data:
+      validated_data['data'] = packing.unpack_data(instance)
+    for attr, value in validated_data.items():
+      setattr(instance, attr, value)
+    if repack:
+      instance.digest_high = instance.digest_low = instance.packed = None
+      packing.pack_vectors([instance])
+    instance.save()
+
+    instance.buckets.all().delete()
+    hist_index.index_vectors([(instance.id, instance.type, instance.packed)])
+    matrix_cache.invalidate(old_file_version_id)
+    matrix_cache.invalidate(instance.file_version_id)
+    return instance
+
+
+class LookupSerializer(serializers.Serializer):
+  """Single function lookup request, of either an uploaded instance or the
+  vectors of a function which was not uploaded"""
+  class NestedVectorSerializer(BaseVectorSerializer):
+    class Meta:
+      model = Vector
+      fields = ('type', 'type_version', 'data')
+
+  instance = serializers.PrimaryKeyRelatedField(
+    queryset=Instance.objects.all(), required=False)
+  vectors = NestedVectorSerializer(many=True, required=False)
+  # file the function belongs to, which is left out of the targets
+  file = serializers.PrimaryKeyRelatedField(queryset=File.objects.all(),
+                                            required=False, allow_null=True)
+  target_project = serializers.PrimaryKeyRelatedField(
+    queryset=Project.objects.all(), required=False, allow_null=True)
+  target_file = serializers.PrimaryKeyRelatedField(
+    queryset=File.objects.all(), required=False, allow_null=True)
+  methods = MethodsField(required=False)
+  top_k = serializers.IntegerField(min_value=1, required=False)
+  min_score = serializers.FloatField(required=False, allow_null=True)
+
+  @staticmethod
+  def validate(attrs):
+    if ('instance' in attrs) == ('vectors' in attrs):
+      raise serializers.ValidationError("Exactly one of instance and vectors "
+                                        "is required")
+    return attrs
 
 
 class MatchSerializer(serializers.ModelSerializer):
+  from_offset = serializers.ReadOnlyField()
+  to_offset = serializers.ReadOnlyField()
+
   class Meta:
     model = Match
-    fields = ('task', 'type', 'score')
+    fields = ('id', 'task', 'type', 'score', 'from_instance', 'from_offset',
+              'to_instance', 'to_offset')
@@ -0,0 +1,97 @@
+"""Incremental reading of streamed request bodies, so large uploads are
+decompressed and parsed a chunk at a time instead of being held in memory as
+a whole.
+"""
+
+import zlib
+
+
+class GzipError(ValueError):
+  """Raised when a gzip compressed stream is corrupt or decompresses past a
+  size limit. Subclassing ValueError makes parsers report it as a malformed
+  request body."""
+
+
+class GzipStream(object):
+  """Read only file-like object decompressing a gzip compressed stream as it
+  is read. Unlike gzip.GzipFile, the underlying stream does not have to
+  support seeking, as request streams don't.
+
+  Every step decompresses at most chunk_size bytes, so a small compressed
+  body can not expand in memory all at once. Reading the whole stream fails
+  once it decompresses past max_size bytes, and reading a line fails once it
+  is longer than max_line bytes."""
+  chunk_size = 64 * 1024
+
+  def __init__(self, stream, max_size=None, max_line=None):
+    self.stream = stream
+    self.max_size = max_size
+    self.max_line = max_line
+    self.decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    self.buffer = b''
+    self.eof = False
+
+  def fill(self, size, limit=None):
+    while not self.eof and (size is None or len(self.buffer) < size):
+      data = self.decompressor.unconsumed_tail
+      if not data:
+        data = self.stream.read(self.chunk_size)
+      try:
+        if data:
+          self.buffer += self.decompressor.decompress(data, self.chunk_size)
+        else:
+          self.buffer += self.decompressor.flush()
+          self.eof = True
+      except zlib.error as ex:
+        raise GzipError("Invalid gzip stream: {}".format(ex))
+
+      if limit is not None and len(self.buffer) > limit:
+        raise GzipError("Decompressed body exceeds {} bytes".format(limit))
+
+  def read(self, size=-1):
+    if size is None or size < 0:
+      self.fill(None, self.max_size)
+      size = len(self.buffer)
+    else:
+      self.fill(size)
+    data, self.buffer = self.buffer[:size], self.buffer[size:]
+    return data
+
+  def readline(self, size=-1):
+    while b'\n' not in self.buffer and not self.eof:
+      if self.max_line is not None and len(self.buffer) > self.max_line:
+        break
+      self.fill(len(self.buffer) + self.chunk_size)
+    length = self.buffer.find(b'\n')
+    end = length + 1
+    if length < 0:
+      length = end = len(self.buffer)
+    if self.max_line is not None and length > self.max_line:
+      raise GzipError("Line exceeds {} bytes".format(self.max_line))
+    if size is not None and size >= 0:
+      end = min(end, size)
+    line, self.buffer = self.buffer[:end], self.buffer[end:]
+    return line
+
+  def __iter__(self):
+    return iter(self.readline, b'')
+
+
+def iter_lines(stream):
+  """Yield the non empty lines of a stream, without line endings"""
+  for line in iter(stream.readline, b''):
+    line = line.strip()
+    if line:
+      yield line
+
+
+def iter_batches(iterable, batch_size):
+  """Yield lists of up to batch_size consecutive items of an iterable"""
+  batch = []
+  for item in iterable:
+    batch.append(item)
+    if len(batch) >= batch_size:
+      yield batch
+      batch = []
+  if batch:
+    yield batch
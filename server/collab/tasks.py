@@ -1,72 +1,463 @@
+import hashlib
+import itertools
+
+from django.conf import settings
+from django.db import connection, transaction
 from django.utils.timezone import now
-from django.db.models import F
-from collab.models import Task, Vector, Match
-from collab import matches
+from django.db.models import F, Q, Count, Max
+from collab.models import Task, TaskCoverage, Vector, Match, BestMatch
+from collab import matches, packing
 
-from celery import shared_task
+from celery import shared_task, chord
 
 
 @shared_task
-def match(task_id):
+def match(task_id, incremental=False):
   try:
     # recording the task has started
     task = Task.objects.filter(id=task_id)
-    task.update(status=Task.STATUS_STARTED, progress=0,
-                progress_max=len(matches.match_list),
+    task.update(status=Task.STATUS_STARTED, progress=0, progress_max=None,
                 task_id=match.request.id)
+    cascade = task.values_list('cascade', flat=True)[0]
+    target_versions = cover_target_versions(task_id, incremental)
+    report_unpacked(task_id)
 
-    # get input parameters
-    task_values = task.values_list('id', 'source_file_version__file_id',
-                                   'source_start', 'source_end',
-                                   'source_file_version_id',
-                                   'target_project_id', 'target_file_id')[0]
-    print(task_values)
-    (task_id, source_file, source_start, source_end, source_file_version,
-     target_project, target_file) = task_values
-
-    source_filter = {'file_id': source_file,
-                     'file_version_id': source_file_version}
-    if source_start:
-      source_filter['instance__offset__gte'] = source_start
-    if source_end:
-      source_filter['instance__offset__lte'] = source_end
-    base_source_vectors = Vector.objects.filter(**source_filter)
-
-    target_filter = {}
-    if target_project:
-      target_filter = {'file__project_id': target_project}
-    elif target_file:
-      target_filter = {'file_id': target_file}
-    base_target_vectors = Vector.objects.filter(**target_filter)
-    base_target_vectors = base_target_vectors.exclude(file_id=source_file)
-
+    # split work to a subtask per match type, chunk of source vectors and
+    # shard of target files, letting all available workers take part in a
+    # single task
     print("Running task {}".format(match.request.id))
-    # TODO: order might be important here
-    for match_type in matches.match_list:
-      print(match_type)
-      start = now()
-      source_vectors = base_source_vectors.filter(type=match_type.vector_type)
-      target_vectors = base_target_vectors.filter(type=match_type.vector_type)
-
-      if source_vectors.count() and target_vectors.count():
-        match_objs = gen_match_objs(task_id, match_type, source_vectors,
-                                    target_vectors)
-        Match.objects.bulk_create(match_objs, batch_size=10000)
-      print("\tTook: {}".format(now() - start))
-
-      task.update(progress=F('progress') + 1)
+    stages = get_task_stages(task_id)
+    stage_subtasks = [gen_stage_subtasks(task_id, match_type, target_versions)
+                      for match_type in stages]
+    stage_sizes = [len(subtasks) for subtasks in stage_subtasks]
+    print("\tSplit to {} subtasks".format(sum(stage_sizes)))
+    task.update(progress_max=sum(stage_sizes))
+
+    if cascade:
+      # later stages depend on the matches of earlier ones, so each stage is
+      # split only once all previous stages are done
+      match_stage(task_id, 0, stage_sizes, target_versions)
+      return
+
+    subtasks = [subtask for subtasks in stage_subtasks for subtask in subtasks]
+    if not subtasks:
+      task.update(status=Task.STATUS_DONE, finished=now())
+      return
+    run_chord(task_id, subtasks, match_done.si(task_id))
+  except Exception:
+    task.update(status=Task.STATUS_FAILED, finished=now())
+    raise
+
+
+@shared_task
+def match_stage(task_id, stage_i, stage_sizes, target_versions=None):
+  """Run the subtasks of a single cascade stage, continuing to the next stage
+  once they are all done"""
+  task = Task.objects.filter(id=task_id)
+  try:
+    stages = get_task_stages(task_id)
+    while stage_i < len(stages):
+      subtasks = gen_stage_subtasks(task_id, stages[stage_i], target_versions)
+      skipped = stage_sizes[stage_i] - len(subtasks)
+      print("Running stage {} in {} subtasks, skipping {}"
+            "".format(stages[stage_i], len(subtasks), skipped))
+      if skipped:
+        task.update(progress_max=F('progress_max') - skipped)
+
+      if subtasks:
+        callback = match_stage.si(task_id, stage_i + 1, stage_sizes,
+                                  target_versions)
+        run_chord(task_id, subtasks, callback)
+        return
+      stage_i += 1
+  except Exception:
+    task.update(status=Task.STATUS_FAILED, finished=now())
+    raise
+
+  match_done(task_id)
+
+
+@shared_task
+def match_chunk(task_id, match_type_name, source_start, source_end,
+                target_files, target_versions=None):
+  task = Task.objects.filter(id=task_id)
+  try:
+    match_type = matches.match_types[match_type_name]
+    top_k, min_score = task.values_list('top_k', 'min_score')[0]
+
+    print("Running {} for source vectors {}-{} against {} files"
+          "".format(match_type, source_start, source_end, len(target_files)))
+    start = now()
+    source_vectors, target_vectors = get_stage_vectors(task_id, match_type,
+                                                       target_versions)
+    source_vectors = source_vectors.filter(id__gte=source_start,
+                                           id__lte=source_end)
+    target_vectors = target_vectors.filter(file_id__in=target_files)
+
+    if match_type.in_database and settings.MATCH_IN_DATABASE:
+      match_count = match_type.match_in_db(task_id, source_vectors,
+                                           target_vectors)
+      print("\tMatched in database: {}".format(match_count))
+    else:
+      match_objs = gen_match_objs(task_id, match_type, source_vectors,
+                                  target_vectors, top_k=top_k,
+                                  min_score=min_score)
+      match_count = insert_batches(match_objs,
+                                   settings.MATCH_INSERT_BATCH_SIZE)
+      print("\tMatched: {}".format(match_count))
+    print("\tTook: {}".format(now() - start))
+
+    task.update(progress=F('progress') + 1)
   except Exception:
     task.update(status=Task.STATUS_FAILED, finished=now())
     raise
 
-  task.update(status=Task.STATUS_DONE, finished=now())
+
+@shared_task
+def match_done(task_id):
+  task = Task.objects.filter(id=task_id)
+  try:
+    # every target shard kept its own top_k matches, keep only the global
+    # top_k matches of each source vector
+    top_k = task.values_list('top_k', flat=True)[0]
+    if top_k:
+      for match_type in matches.match_list:
+        if match_type.supports_top_k:
+          merge_top_k(task_id, match_type.match_type, top_k)
+
+    summarize_matches(task_id)
+  except Exception:
+    task.update(status=Task.STATUS_FAILED, finished=now())
+    raise
+
+  task.exclude(status=Task.STATUS_FAILED).update(status=Task.STATUS_DONE,
+                                                 finished=now())
+
+
+@shared_task
+def match_failed(task_id):
+  task = Task.objects.filter(id=task_id)
+  task.update(status=Task.STATUS_FAILED, finished=now())
+
+
+def enqueue(task_id, incremental=False):
+  """Route a task to a queue by its estimated size and send it there"""
+  source_vectors, target_vectors = get_task_vectors(task_id)
+  size = source_vectors.count() * target_vectors.count()
+  if size <= settings.MATCH_INTERACTIVE_MAX_SIZE:
+    queue = Task.QUEUE_INTERACTIVE
+  else:
+    queue = Task.QUEUE_BULK
+  print("Sending task {} of estimated size {} to {} queue"
+        "".format(task_id, size, queue))
+
+  Task.objects.filter(id=task_id).update(queue=queue)
+  match.apply_async(kwargs={'task_id': task_id, 'incremental': incremental},
+                    **get_routing(task_id))
+
+
+def get_routing(task_id):
+  """Return the celery routing options for all messages of a task"""
+  queue = Task.objects.filter(id=task_id).values_list('queue', flat=True)[0]
+  return {'queue': queue, 'routing_key': queue,
+          'priority': settings.MATCH_QUEUE_PRIORITIES[queue]}
+
+
+def run_chord(task_id, subtasks, callback):
+  """Run subtasks in parallel, calling callback once all of them are done and
+  failing the task if any of them fails"""
+  routing = get_routing(task_id)
+  callback.set(**routing)
+  callback.link_error(match_failed.si(task_id).set(**routing))
+  chord([subtask.set(**routing) for subtask in subtasks])(callback)
+
+
+def get_task_stages(task_id):
+  """Return the match types of the match methods requested for a task, in the
+  order they run"""
+  methods = Task.objects.get(id=task_id).get_methods()
+  return [match_type for match_type in matches.match_list
+          if match_type.method in methods]
+
+
+def cover_target_versions(task_id, incremental):
+  """Record the target file versions matched by a run of a task along with
+  their number of vectors and highest vector id, and the digest of the target
+  vectors matched. Vectors added after they're recorded are left for a later
+  run.
+  Returns None for a full run, matching all vectors covered by the task. For
+  an incremental run, returns a list of (file version id, vector id) pairs of
+  the new or changed file versions, where only vectors with a higher id than
+  the paired one are matched."""
+  _, target_vectors = get_task_vectors(task_id)
+  fingerprints = get_fingerprints(target_vectors)
+
+  coverages = TaskCoverage.objects.filter(task_id=task_id)
+  covered = coverages.values_list('file_version_id', 'vector_count',
+                                  'max_vector_id')
+  covered = {file_version_id: (vector_count, max_vector_id)
+             for file_version_id, vector_count, max_vector_id in covered}
+
+  with transaction.atomic():
+    coverages.delete()
+    TaskCoverage.objects.bulk_create(
+      TaskCoverage(task_id=task_id, file_version_id=file_version_id,
+                   vector_count=vector_count, max_vector_id=max_vector_id)
+      for file_version_id, vector_count, max_vector_id in fingerprints)
+    Task.objects.filter(id=task_id).update(
+      target_digest=get_fingerprints_digest(fingerprints))
+
+  if not incremental:
+    return None
+
+  changed_versions = []
+  for file_version_id, vector_count, max_vector_id in fingerprints:
+    covered_fingerprint = covered.get(file_version_id, (0, 0))
+    if covered_fingerprint != (vector_count, max_vector_id):
+      changed_versions.append([file_version_id, covered_fingerprint[1]])
+  print("\tIncremental run for {} new or changed file versions"
+        "".format(len(changed_versions)))
+  return changed_versions
+
+
+def report_unpacked(task_id):
+  """Warn about task vectors left out of matching for having no compact
+  representation"""
+  source_vectors, target_vectors = get_task_vectors(task_id)
+  source_count = packing.get_unpacked(source_vectors).count()
+  target_count = packing.get_unpacked(target_vectors).count()
+  if source_count or target_count:
+    print("\tSkipping {} source and {} target vectors stored before vectors "
+          "were packed, run the pack_vectors management command to match "
+          "them".format(source_count, target_count))
+
+
+def gen_stage_subtasks(task_id, match_type, target_versions=None):
+  """Return the match_chunk subtasks of a single match type"""
+  source_vectors, target_vectors = get_stage_vectors(task_id, match_type,
+                                                     target_versions)
+  if not target_vectors.exists():
+    return []
+
+  target_shards = list(gen_file_shards(target_vectors))
+  return [match_chunk.si(task_id, match_type.match_type, source_start,
+                         source_end, target_files, target_versions)
+          for source_start, source_end in gen_id_ranges(source_vectors)
+          for target_files in target_shards]
+
+
+def get_stage_vectors(task_id, match_type, target_versions=None):
+  """Build the source and target vector querysets of a single match type of a
+  task. Target vectors are limited to those covered by the task, and further
+  to the (file version id, vector id) pairs of target_versions if given. In
+  cascade mode, instances resolved by earlier match types are left out."""
+  base_source_vectors, base_target_vectors = get_task_vectors(task_id)
+  vector_types = match_type.get_vector_types()
+  source_vectors = base_source_vectors.filter(type__in=vector_types)
+  target_vectors = base_target_vectors.filter(
+    type__in=vector_types, file_version__coverages__task_id=task_id,
+    id__lte=F('file_version__coverages__max_vector_id'))
+  if target_versions is not None:
+    versions_filter = Q(pk__in=[])
+    for file_version_id, after_vector_id in target_versions:
+      versions_filter |= Q(file_version_id=file_version_id,
+                           id__gt=after_vector_id)
+    target_vectors = target_vectors.filter(versions_filter)
+
+  task_values = Task.objects.filter(id=task_id)
+  cascade, cascade_targets = task_values.values_list('cascade',
+                                                     'cascade_targets')[0]
+  if not cascade:
+    return source_vectors, target_vectors
+
+  earlier_types = matches.match_list[:matches.match_list.index(match_type)]
+  resolved_types = [resolved_type for earlier_type in earlier_types
+                    if earlier_type.resolves
+                    for resolved_type in earlier_type.get_match_types()]
+  if resolved_types:
+    resolved = Match.objects.filter(task_id=task_id, type__in=resolved_types)
+    source_vectors = source_vectors.exclude(
+      instance_id__in=resolved.values('from_instance_id'))
+    if cascade_targets:
+      target_vectors = target_vectors.exclude(
+        instance_id__in=resolved.values('to_instance_id'))
+  return source_vectors, target_vectors
+
+
+def get_task_vectors(task_id):
+  """Build the base source and target vector querysets of a task, before
+  filtering by any vector type"""
+  task_values = Task.objects.filter(id=task_id)
+  task_values = task_values.values_list('source_file_version__file_id',
+                                        'source_start', 'source_end',
+                                        'source_file_version_id',
+                                        'target_project_id',
+                                        'target_file_id')[0]
+  (source_file, source_start, source_end, source_file_version,
+   target_project, target_file) = task_values
+
+  source_filter = {'file_id': source_file,
+                   'file_version_id': source_file_version}
+  if source_start:
+    source_filter['instance__offset__gte'] = source_start
+  if source_end:
+    source_filter['instance__offset__lte'] = source_end
+  base_source_vectors = Vector.objects.filter(**source_filter)
+
+  base_target_vectors = get_target_vectors(source_file, target_project,
+                                           target_file)
+
+  return base_source_vectors, base_target_vectors
+
+
+def get_target_vectors(source_file, target_project, target_file):
+  """Build the base target vector queryset of a task, before filtering by any
+  vector type"""
+  target_filter = {}
+  if target_project:
+    target_filter = {'file__project_id': target_project}
+  elif target_file:
+    target_filter = {'file_id': target_file}
+  target_vectors = Vector.objects.filter(**target_filter)
+  return target_vectors.exclude(file_id=source_file)
+
+
+def get_target_digest(source_file, target_project, target_file):
+  """Return a digest of the current target vectors of a task"""
+  target_vectors = get_target_vectors(source_file, target_project, target_file)
+  return get_fingerprints_digest(get_fingerprints(target_vectors))
+
+
+def get_fingerprints(vectors):
+  """Return a list of (file version id, vector count, max vector id) of all
+  file versions of a vector queryset, ordered by file version id. A
+  fingerprint changes whenever vectors are added to or removed from its file
+  version."""
+  file_versions = vectors.values_list('file_version_id')
+  file_versions = file_versions.annotate(Count('id'), Max('id'))
+  return list(file_versions.order_by('file_version_id'))
+
+
+def get_fingerprints_digest(fingerprints):
+  digest = hashlib.md5()
+  for values in fingerprints:
+    digest.update("{}:{}:{};".format(*values).encode('ascii'))
+  return digest.hexdigest()
+
+
+def gen_id_ranges(vectors):
+  """Split a vector queryset into inclusive id ranges of at most
+  MATCH_SOURCE_CHUNK_SIZE vectors each"""
+  vector_ids = list(vectors.order_by('id').values_list('id', flat=True))
+  chunk_size = settings.MATCH_SOURCE_CHUNK_SIZE
+  for chunk_start in range(0, len(vector_ids), chunk_size):
+    chunk = vector_ids[chunk_start:chunk_start + chunk_size]
+    yield chunk[0], chunk[-1]
+
+
+def gen_file_shards(vectors):
+  """Split the files of a vector queryset into lists of file ids, each holding
+  about MATCH_TARGET_SHARD_SIZE vectors"""
+  file_counts = vectors.values_list('file_id').annotate(Count('id'))
+  shard, shard_size = [], 0
+  for file_id, file_count in file_counts.order_by('file_id'):
+    shard.append(file_id)
+    shard_size += file_count
+    if shard_size >= settings.MATCH_TARGET_SHARD_SIZE:
+      yield shard
+      shard, shard_size = [], 0
+  if shard:
+    yield shard
+
+
+def merge_top_k(task_id, match_type_name, top_k, batch_size=1000):
+  """Delete all but the top_k best scoring matches of every source vector.
+  Source vectors are handled batch_size at a time, deleting the excess
+  matches of each batch before the next one is read, so memory use is
+  bounded by the matches of a single batch of source vectors."""
+  task_matches = Match.objects.filter(task_id=task_id, type=match_type_name)
+  source_ids = task_matches.order_by('from_vector_id').distinct()
+  source_ids = source_ids.values_list('from_vector_id', flat=True)
+
+  last_vector_id = None
+  while True:
+    batch_sources = source_ids
+    if last_vector_id is not None:
+      batch_sources = batch_sources.filter(from_vector_id__gt=last_vector_id)
+    batch_sources = list(batch_sources[:batch_size])
+    if not batch_sources:
+      break
+    last_vector_id = batch_sources[-1]
+
+    match_values = task_matches.filter(from_vector_id__gte=batch_sources[0],
+                                       from_vector_id__lte=last_vector_id)
+    match_values = match_values.order_by('from_vector_id', '-score', 'id')
+    match_values = match_values.values_list('id', 'from_vector_id')
+
+    excess_ids = []
+    batch_vector_id, vector_count = None, 0
+    for match_id, from_vector_id in match_values:
+      if from_vector_id == batch_vector_id:
+        vector_count += 1
+      else:
+        batch_vector_id, vector_count = from_vector_id, 1
+      if vector_count > top_k:
+        excess_ids.append(match_id)
+
+    for batch_start in range(0, len(excess_ids), batch_size):
+      batch = excess_ids[batch_start:batch_start + batch_size]
+      Match.objects.filter(id__in=batch).delete()
+
+
+def insert_batches(match_objs, batch_size):
+  """Insert Match objects from an iterable in batches of batch_size, committing
+  and releasing each batch before the next one is taken, so memory use does
+  not depend on the number of matches and they are visible while the task is
+  still running. Returns the number of matches inserted."""
+  match_objs = iter(match_objs)
+  match_count = 0
+  while True:
+    batch = list(itertools.islice(match_objs, batch_size))
+    if not batch:
+      break
+    with transaction.atomic():
+      Match.objects.bulk_create(batch)
+    match_count += len(batch)
+  return match_count
+
+
+def summarize_matches(task_id):
+  """Fill in the best scoring match of every source instance and match type
+  of a task, replacing any previous summary. Ties are broken by the lowest
+  target instance id."""
+  BestMatch.objects.filter(task_id=task_id).delete()
+
+  sql = ("INSERT INTO {best_match_table} (task_id, from_instance_id, "
+         "to_instance_id, type, score) "
+         "SELECT m.task_id, m.from_instance_id, MIN(m.to_instance_id), "
+         "m.type, m.score "
+         "FROM {match_table} m JOIN ("
+         "  SELECT from_instance_id, type, MAX(score) AS score "
+         "  FROM {match_table} WHERE task_id = %s "
+         "  GROUP BY from_instance_id, type) b "
+         "ON m.from_instance_id = b.from_instance_id AND m.type = b.type "
+         "AND m.score = b.score "
+         "WHERE m.task_id = %s "
+         "GROUP BY m.task_id, m.from_instance_id, m.type, m.score")
+  sql = sql.format(best_match_table=BestMatch._meta.db_table,
+                   match_table=Match._meta.db_table)
+
+  with connection.cursor() as cursor:
+    cursor.execute(sql, (task_id, task_id))
+    return cursor.rowcount
 
 
-def gen_match_objs(task_id, match_type, source_vectors, target_vectors):
-  matches = match_type.match(source_vectors, target_vectors)
-  for source, source_instance, target, target_instance, score in matches:
+def gen_match_objs(task_id, match_type, source_vectors, target_vectors,
+                   **kwargs):
+  matches = match_type.match(source_vectors, target_vectors, **kwargs)
+  for (source, source_instance, target, target_instance, score,
+       mat_type) in matches:
     mat = Match(task_id=task_id, from_vector_id=source, to_vector_id=target,
                 from_instance_id=source_instance,
-                to_instance_id=target_instance,
-                score=score, type=match_type.match_type)
+                to_instance_id=target_instance, score=score, type=mat_type)
     yield mat
@@ -10,6 +10,7 @@ router.register(r'file_versions', views.FileVersionViewSet)
 router.register(r'tasks', views.TaskViewSet)
 router.register(r'instances', views.InstanceViewSet)
 router.register(r'vectors', views.VectorViewSet)
+router.register(r'matches', views.MatchViewSet)
 
 urlpatterns = [
   url(r'^', include(router.urls)),
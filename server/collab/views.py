@@ -1,13 +1,22 @@
+import json
+import time
+
+from django.conf import settings
+from django.db.models import F
 from rest_framework import (viewsets, permissions, mixins, decorators, status,
                             response)
+from rest_framework.exceptions import ValidationError
 from collab.models import (Project, File, FileVersion, Task, Instance, Vector,
-                           Match)
+                           Match, Annotation)
 from collab.serializers import (ProjectSerializer, FileSerializer,
                                 FileVersionSerializer, TaskSerializer,
                                 TaskEditSerializer, InstanceSerializer,
-                                VectorSerializer, MatchSerializer)
+                                VectorSerializer, MatchSerializer,
+                                LookupSerializer, create_instances,
+                                exclude_uploaded)
+from collab.pagination import MatchKeysetPagination
 from collab.permissions import IsOwnerOrReadOnly
-from collab import tasks
+from collab import lookup, packing, streaming, tasks
 
 
 class ViewSetOwnerMixin(object):
@@ -80,9 +89,121 @@ class TaskViewSet(mixins.CreateModelMixin, mixins.RetrieveModelMixin,
                         IsOwnerOrReadOnly)
   filter_fields = ('task_id', 'created', 'finished', 'owner', 'status')
 
-  def perform_create(self, serializer):
-    task = serializer.save(owner=self.request.user)
-    tasks.match.delay(task_id=task.id)
+  # task fields that have to be equal, along with the digest of the target
+  # vectors, for a completed task's results to be reused
+  reuse_fields = ('source_file_version_id', 'source_start', 'source_end',
+                  'target_project_id', 'target_file_id', 'methods', 'top_k',
+                  'min_score', 'cascade', 'cascade_targets')
+
+  def create(self, request, *args, **kwargs):
+    serializer = self.get_serializer(data=request.data)
+    serializer.is_valid(raise_exception=True)
+
+    task = Task(owner=request.user, **serializer.validated_data)
+    target_digest = tasks.get_target_digest(task.source_file_version.file_id,
+                                            task.target_project_id,
+                                            task.target_file_id)
+    reuse_filter = {field: getattr(task, field)
+                    for field in self.reuse_fields}
+    reusable_tasks = Task.objects.filter(owner=request.user,
+                                         status=Task.STATUS_DONE,
+                                         target_digest=target_digest,
+                                         **reuse_filter)
+    reusable_task = reusable_tasks.order_by('-finished').first()
+
+    created = reusable_task is None
+    if created:
+      self.perform_create(serializer, target_digest=target_digest)
+    else:
+      serializer.instance = reusable_task
+
+    resp_status = status.HTTP_201_CREATED if created else status.HTTP_200_OK
+    response_data = serializer.data
+    response_data['newly_created'] = created
+    return response.Response(response_data, status=resp_status,
+                             headers=self.get_success_headers(response_data))
+
+  def perform_create(self, serializer, target_digest=None):
+    task = serializer.save(owner=self.request.user,
+                           target_digest=target_digest)
+    tasks.enqueue(task.id)
+
+  @decorators.detail_route(methods=['GET'])
+  def wait(self, request, pk):
+    """Long poll a task, responding once its status or progress differ from
+    the given status and progress, it is finished, or timeout seconds have
+    passed"""
+    del pk
+    task = self.get_object()
+    try:
+      last_status = request.query_params.get('status', task.status)
+      last_progress = int(request.query_params.get('progress', task.progress))
+      timeout = float(request.query_params.get('timeout',
+                                               settings.TASK_WAIT_TIMEOUT))
+    except ValueError:
+      return response.Response({'detail': "Invalid progress or timeout"},
+                               status=status.HTTP_400_BAD_REQUEST)
+
+    deadline = time.time() + min(timeout, settings.TASK_WAIT_TIMEOUT)
+    running = (Task.STATUS_PENDING, Task.STATUS_STARTED)
+    interval = settings.TASK_WAIT_INTERVAL
+    while all((task.status in running,
+               (task.status, task.progress) == (last_status, last_progress),
+               time.time() < deadline)):
+      time.sleep(min(interval, max(deadline - time.time(), 0)))
+      interval = min(interval * 2, settings.TASK_WAIT_MAX_INTERVAL)
+      task.refresh_from_db()
+
+    serializer = self.get_serializer(task)
+    return response.Response(serializer.data)
+
+  @decorators.detail_route(methods=['GET'])
+  def summary(self, request, pk):
+    """Return the best match of every source instance and match type of a
+    completed task, along with the name of the matched instance"""
+    del pk
+    task = self.get_object()
+    best_matches = task.best_matches.order_by('from_instance_id', 'type')
+    if 'type' in request.query_params:
+      best_matches = best_matches.filter(type=request.query_params['type'])
+    best_matches = best_matches.annotate(
+      from_offset=F('from_instance__offset'),
+      to_offset=F('to_instance__offset'),
+      to_file_version=F('to_instance__file_version_id'))
+    best_matches = list(best_matches.values('from_instance', 'from_offset',
+                                            'to_instance', 'to_offset',
+                                            'to_file_version', 'type',
+                                            'score'))
+
+    names = Annotation.objects.filter(
+      type=Annotation.TYPE_NAME,
+      instance__in=set(best_match['to_instance']
+                       for best_match in best_matches))
+    names = dict(names.values_list('instance_id', 'data'))
+    for best_match in best_matches:
+      best_match['to_name'] = names.get(best_match['to_instance'])
+
+    return response.Response(best_matches)
+
+  @decorators.detail_route(methods=['POST'])
+  def refresh(self, request, pk):
+    """Incrementally match a completed task against target vectors added since
+    it last ran, appending to its matches. The task's target digest is updated
+    by the run to cover what it actually matched."""
+    del pk
+    task = self.get_object()
+    if task.status != Task.STATUS_DONE:
+      return response.Response({'detail': "Only completed tasks can be "
+                                          "refreshed"},
+                               status=status.HTTP_409_CONFLICT)
+
+    task.status = Task.STATUS_PENDING
+    task.save(update_fields=['status'])
+    tasks.enqueue(task.id, incremental=True)
+
+    task.refresh_from_db()
+    serializer = self.get_serializer(task)
+    return response.Response(serializer.data)
 
   def get_serializer_class(self):
     serializer_class = self.serializer_class
@@ -92,9 +213,13 @@ class TaskViewSet(mixins.CreateModelMixin, mixins.RetrieveModelMixin,
 
 
 class MatchViewSet(viewsets.ReadOnlyModelViewSet):
-  queryset = Match.objects.all()
+  queryset = Match.objects.annotate(from_offset=F('from_instance__offset'),
+                                    to_offset=F('to_instance__offset'))
   serializer_class = MatchSerializer
-  filter_fields = ('task', 'type', 'score')
+  permission_classes = (permissions.IsAuthenticatedOrReadOnly,)
+  pagination_class = MatchKeysetPagination
+  filter_fields = {'task': ['exact'], 'type': ['exact'],
+                   'score': ['exact', 'gt', 'gte', 'lt', 'lte']}
 
 
 class InstanceViewSet(ViewSetManyAllowedMixin, ViewSetOwnerMixin,
@@ -103,6 +228,83 @@ class InstanceViewSet(ViewSetManyAllowedMixin, ViewSetOwnerMixin,
   serializer_class = InstanceSerializer
   filter_fields = ('owner', 'file_version', 'type')
 
+  @decorators.list_route(methods=['POST'])
+  def stream(self, request):
+    """Create instances from a newline delimited JSON stream of instances.
+    Instances are parsed and created in batches as the stream is read, and
+    invalid lines are reported without failing the rest of the stream.
+    Instances already uploaded are skipped, so a failed upload can be retried
+    in full even if some of its batches were stored.
+    Compressed streams are decompressed as they're read by
+    GzipRequestMiddleware, which drops their content length, so the body is
+    read from the underlying django request."""
+    body = request._request
+
+    serializer = self.get_serializer()
+    accepted, skipped, rejected, errors = 0, 0, 0, []
+    lines = enumerate(streaming.iter_lines(body), 1)
+    try:
+      for batch in streaming.iter_batches(lines,
+                                          settings.INSTANCE_STREAM_BATCH_SIZE):
+        instances_data = []
+        for line_number, line in batch:
+          try:
+            instance_data = serializer.run_validation(
+              json.loads(line.decode('utf-8')))
+          except (ValueError, UnicodeError, ValidationError) as ex:
+            rejected += 1
+            if len(errors) < settings.INSTANCE_STREAM_ERRORS:
+              detail = getattr(ex, 'detail', [str(ex)])
+              errors.append({'line': line_number, 'errors': detail})
+          else:
+            instance_data['owner'] = request.user
+            instances_data.append(instance_data)
+
+        new_instances_data = exclude_uploaded(instances_data)
+        skipped += len(instances_data) - len(new_instances_data)
+        if new_instances_data:
+          create_instances(new_instances_data)
+          accepted += len(new_instances_data)
+    except streaming.GzipError as ex:
+      return response.Response({'detail': str(ex), 'accepted': accepted},
+                               status=status.HTTP_400_BAD_REQUEST)
+
+    return response.Response({'accepted': accepted, 'skipped': skipped,
+                              'rejected': rejected, 'errors': errors})
+
+  @decorators.list_route(methods=['POST'])
+  def lookup(self, request):
+    """Return the best matches of a single function right away, without
+    creating a match task"""
+    serializer = LookupSerializer(data=request.data)
+    serializer.is_valid(raise_exception=True)
+    data = serializer.validated_data
+
+    if 'instance' in data:
+      # vectors stored before vectors were packed on upload are not matched
+      # until converted by the pack_vectors command
+      vectors = list(packing.get_packed(data['instance'].vectors.all()))
+      source_file = data['instance'].file_version.file_id
+    else:
+      # looked up vectors are never stored, so mnemonics unknown to the
+      # server are left out rather than added to the vocabulary
+      vectors = [Vector(**vector_data) for vector_data in data['vectors']]
+      packing.pack_vectors(vectors, create_mnemonics=False)
+      source_file = data['file'].id if data.get('file') else None
+
+    target_project = data.get('target_project')
+    target_file = data.get('target_file')
+    target = tasks.get_target_vectors(source_file,
+                                      target_project and target_project.id,
+                                      target_file and target_file.id)
+
+    methods = data.get('methods', Task._meta.get_field('methods').default)
+    lookup_matches = lookup.lookup(vectors, target, methods.split(','),
+                                   data.get('top_k',
+                                            settings.MATCH_LOOKUP_TOP_K),
+                                   data.get('min_score'))
+    return response.Response({'matches': lookup_matches})
+
 
 class VectorViewSet(ViewSetManyAllowedMixin, viewsets.ModelViewSet):
   queryset = Vector.objects.all()
@@ -12,6 +12,8 @@ https://docs.djangoproject.com/en/1.9/ref/settings/
 
 import os
 
+from kombu import Queue
+
 # Build paths inside the project like this: os.path.join(BASE_DIR, ...)
 BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 
@@ -57,6 +59,8 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE_CLASSES = [
+    'django.middleware.gzip.GZipMiddleware',
+    'collab.middleware.GzipRequestMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -167,3 +171,99 @@ CELERY_RESULT_BACKEND = 'djcelery.backends.database:DatabaseBackend'
 CELERY_ACCEPT_CONTENT = ['json']
 CELERY_TASK_SERIALIZER = 'json'
 CELERY_RESULT_SERIALIZER = 'json'
+
+# Match tasks are routed to either the interactive or the bulk queue by their
+# estimated size, and each queue is consumed by its own workers (see
+# start_celery.sh), so small tasks never wait behind long running ones.
+# Priorities only take effect within a queue, on brokers supporting them.
+# The database result backend has no native chord support, so chord callbacks
+# are triggered by celery.chord_unlock polling every second. Those messages
+# carry no queue of their own and are routed to the light control queue,
+# consumed by the interactive workers, so completing a task never waits behind
+# long running bulk subtasks.
+CELERY_QUEUES = (Queue('interactive', routing_key='interactive',
+                       queue_arguments={'x-max-priority': 10}),
+                 Queue('bulk', routing_key='bulk',
+                       queue_arguments={'x-max-priority': 10}),
+                 Queue('control', routing_key='control'))
+CELERY_ROUTES = {'celery.chord_unlock': {'queue': 'control',
+                                         'routing_key': 'control'}}
+CELERY_DEFAULT_QUEUE = 'bulk'
+CELERY_DEFAULT_ROUTING_KEY = 'bulk'
+CELERYD_PREFETCH_MULTIPLIER = 1
+
+
+# Match configuration
+
+# Run matches which support it (i.e. hash identity matches) as a single
+# set-based statement inside the database, instead of loading vectors into the
+# worker
+MATCH_IN_DATABASE = True
+
+# Tasks estimated at no more than this many source and target vector pairs are
+# run in the interactive queue, and larger tasks in the bulk queue. Every
+# celery message of a task is sent with its queue's priority.
+MATCH_INTERACTIVE_MAX_SIZE = 100 * 1000 * 1000
+MATCH_QUEUE_PRIORITIES = {'interactive': 9, 'bulk': 0}
+
+# Maximal number of matches of every match type returned by a single function
+# lookup
+MATCH_LOOKUP_TOP_K = 10
+
+# Longest time, in seconds, a task wait request is held open waiting for the
+# task to change, and how often the task is checked meanwhile. The interval
+# doubles after every check, up to the maximal interval
+TASK_WAIT_TIMEOUT = 30
+TASK_WAIT_INTERVAL = 1
+TASK_WAIT_MAX_INTERVAL = 8
+
+# Default and maximal number of matches in a single page of match results
+MATCH_PAGE_SIZE = 1000
+MATCH_MAX_PAGE_SIZE = 10000
+
+
+# Upload configuration
+
+# Streamed instance uploads are created this many instances at a time, and
+# at most this many invalid lines are reported back
+INSTANCE_STREAM_BATCH_SIZE = 500
+INSTANCE_STREAM_ERRORS = 100
+
+# Lines of compressed streamed uploads are limited to this many bytes once
+# decompressed, other compressed request bodies are limited by
+# DATA_UPLOAD_MAX_MEMORY_SIZE
+REQUEST_STREAM_MAX_LINE_SIZE = 16 * 1024 * 1024
+
+# Tasks are split into a celery subtask per match type and chunk of this many
+# source vectors, so a single task can be processed by all workers at once
+MATCH_SOURCE_CHUNK_SIZE = 5000
+
+# Target vectors are sharded by file, so that every subtask matches against
+# files holding about this many vectors, and results of all shards are merged
+# when the task is done
+MATCH_TARGET_SHARD_SIZE = 500000
+
+# Matches are inserted and committed in batches of this size as they are
+# scored, bounding the number of matches held in memory at once
+MATCH_INSERT_BATCH_SIZE = 10000
+
+# Upper bound, in bytes, for the score matrix tiles held in memory at once
+# while matching histogram vectors
+HISTOGRAM_MATCH_MEMORY_BUDGET = 256 * 1024 * 1024
+
+# Directory prepared histogram matrices of target file versions are cached in,
+# set to None to disable caching and rebuild target matrices in every task
+HISTOGRAM_MATRIX_CACHE_DIR = os.path.join(BASE_DIR, 'cache', 'matrices')
+
+# Histogram vectors are indexed using random projection LSH upon upload, and
+# when enabled the index is queried for candidates instead of scoring every
+# target vector. Changing the index dimensions requires rebuilding the index
+# using the index_vectors management command.
+HISTOGRAM_INDEX_ENABLED = True
+HISTOGRAM_INDEX_BANDS = 8
+HISTOGRAM_INDEX_BAND_BITS = 12
+# Only this many target vectors of a single index bucket are taken as
+# candidates, so buckets of many identical histograms (e.g. thunks) don't
+# grow candidates as source times target vectors. Index queries are run in
+# source chunks sized by HISTOGRAM_MATCH_MEMORY_BUDGET and this bound.
+HISTOGRAM_INDEX_MAX_BUCKET_SIZE = 1000
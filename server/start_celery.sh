@@ -1,3 +1,11 @@
 #!/bin/sh
 
-celery -A rematch.celery worker -l info
+# interactive and bulk match tasks are consumed by separate workers, so small
+# tasks are picked up right away even while bulk workers are all busy. The
+# interactive workers also poll chord completion of all tasks (control queue)
+celery -A rematch.celery worker -l info -Q interactive,control \
+  -n interactive@%h \
+  -c ${INTERACTIVE_CONCURRENCY:-2} &
+celery -A rematch.celery worker -l info -Q bulk -n bulk@%h \
+  ${BULK_CONCURRENCY:+-c $BULK_CONCURRENCY}
+wait
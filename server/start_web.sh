@@ -4,6 +4,7 @@ webserver_addr=$1
 
 python ./manage.py makemigrations collab
 python ./manage.py migrate
+python ./manage.py pack_vectors
 has_admin=$(echo "select count(*) from auth_user where username='admin';" | python ./manage.py dbshell | sed 's/[^0-9]//g')
 if [ $has_admin -eq 0 ]; then
     echo "Creating admin super user, please enter password"
@@ -0,0 +1,1004 @@
+import pytest
+import gzip
+import io
+import os
+import json
+import hashlib
+
+from django.core.management import call_command
+from django.db import transaction
+
+from collab.models import (Project, File, FileVersion, Instance, Vector,
+                           HistogramBucket, Match, Mnemonic, Task, Annotation)
+from collab.matches import (AssemblyHashMatch, IdentityHashMatch,
+                            MnemonicHistogramMatch)
+from collab import hist_index, matrix_cache, packing, tasks, views
+from rematch.celery import app as celery_app
+
+
+hists = [{'mov': 5, 'push': 2, 'call': 1},
+         {'mov': 1, 'xor': 4},
+         {'mov': 5, 'push': 2, 'call': 2},
+         {'lea': 3, 'ret': 1},
+         {'xor': 4, 'mov': 2, 'ret': 1}]
+
+
+@pytest.fixture(autouse=True)
+def matrix_cache_dir(settings, tmpdir):
+  settings.HISTOGRAM_MATRIX_CACHE_DIR = str(tmpdir.join('matrices'))
+  return settings.HISTOGRAM_MATRIX_CACHE_DIR
+
+
+def create_vectors(user, file_name, hist_list, vector_types=None,
+                   type_version=0, project=None):
+  if vector_types is None:
+    vector_types = ['mnemonic_hist'] * len(hist_list)
+
+  if project is None:
+    project = Project.objects.create(owner=user, private=False)
+  file_obj = File.objects.create(owner=user, project=project, name=file_name,
+                                 description='desc', md5hash='H' * 32)
+  file_version = FileVersion.objects.create(file=file_obj, md5hash='J' * 32)
+  vectors = []
+  for offset, (hist, vector_type) in enumerate(zip(hist_list, vector_types)):
+    instance = Instance.objects.create(owner=user, file_version=file_version,
+                                       type='function', offset=offset)
+    data = json.dumps(hist, sort_keys=True)
+    if vector_type != 'mnemonic_hist':
+      data = hashlib.md5(data.encode('ascii')).hexdigest()
+    vectors.append(Vector(instance=instance, file=file_obj,
+                          file_version=file_version, type=vector_type,
+                          type_version=type_version, data=data))
+  packing.pack_vectors(vectors)
+  for vector in vectors:
+    vector.save()
+  hist_index.index_vectors((vector.id, vector.type, vector.packed)
+                           for vector in vectors)
+  return Vector.objects.filter(file=file_obj)
+
+
+@pytest.mark.django_db
+def test_hist_top_k(admin_user, settings):
+  settings.HISTOGRAM_INDEX_ENABLED = False
+  source = create_vectors(admin_user, 'source', hists[:2])
+  target = create_vectors(admin_user, 'target', hists)
+
+  dense = list(MnemonicHistogramMatch.match(source, target))
+  assert len(dense) == 2 * len(hists)
+
+  top_k = list(MnemonicHistogramMatch.match(source, target, top_k=2))
+  assert len(top_k) == 4
+
+  for source_id in source.values_list('id', flat=True):
+    dense_scores = sorted((m[4] for m in dense if m[0] == source_id),
+                          reverse=True)
+    top_k_scores = sorted((m[4] for m in top_k if m[0] == source_id),
+                          reverse=True)
+    assert top_k_scores == pytest.approx(dense_scores[:2])
+
+
+@pytest.mark.django_db
+def test_hist_min_score(admin_user, settings):
+  settings.HISTOGRAM_INDEX_ENABLED = False
+  source = create_vectors(admin_user, 'source', hists[:2])
+  target = create_vectors(admin_user, 'target', hists)
+
+  matches = list(MnemonicHistogramMatch.match(source, target, min_score=50))
+  assert matches
+  assert all(m[4] >= 50 for m in matches)
+
+
+@pytest.mark.django_db
+@pytest.mark.parametrize('top_k', [None, 2])
+def test_hist_tiled(admin_user, settings, top_k):
+  settings.HISTOGRAM_INDEX_ENABLED = False
+  source = create_vectors(admin_user, 'source', hists[:3])
+  target = create_vectors(admin_user, 'target', hists)
+
+  untiled = list(MnemonicHistogramMatch.match(source, target, top_k=top_k))
+  # budget small enough to force a separate tile for nearly every cell
+  settings.HISTOGRAM_MATCH_MEMORY_BUDGET = 16
+  tiled = list(MnemonicHistogramMatch.match(source, target, top_k=top_k))
+
+  assert sorted(m[:4] for m in tiled) == sorted(m[:4] for m in untiled)
+  untiled_scores = pytest.approx(sorted(m[4] for m in untiled))
+  assert sorted(m[4] for m in tiled) == untiled_scores
+
+
+@pytest.mark.django_db
+def test_hist_index(admin_user):
+  source = create_vectors(admin_user, 'source', hists[:2])
+  target = create_vectors(admin_user, 'target', hists[1:])
+
+  matches = list(MnemonicHistogramMatch.match(source, target, top_k=1))
+  # the second source histogram has an identical target, which must be found
+  source_id = source.get(instance__offset=1).id
+  target_id = target.get(instance__offset=0).id
+  source_matches = [m for m in matches if m[0] == source_id]
+  assert len(source_matches) == 1
+  assert source_matches[0][2] == target_id
+  assert source_matches[0][4] == pytest.approx(100)
+
+  # only candidates are loaded, bypassing the whole file version matrix cache
+  assert not os.path.exists(matrix_cache.get_path(target[0].file_version_id,
+                                                  'mnemonic_hist', 0))
+
+
+@pytest.mark.django_db
+def test_hist_index_bounded(admin_user, settings, monkeypatch):
+  source = create_vectors(admin_user, 'source', hists * 2)
+  target = create_vectors(admin_user, 'target', hists)
+  unchunked = sorted(MnemonicHistogramMatch.match(source, target))
+
+  # chunks of two source histograms give the same matches
+  settings.HISTOGRAM_MATCH_MEMORY_BUDGET = \
+    2 * settings.HISTOGRAM_INDEX_BANDS * \
+    settings.HISTOGRAM_INDEX_MAX_BUCKET_SIZE * \
+    MnemonicHistogramMatch.candidate_pair_size
+  chunked = sorted(MnemonicHistogramMatch.match(source, target))
+  assert [m[:4] for m in chunked] == [m[:4] for m in unchunked]
+  assert [m[4] for m in chunked] == pytest.approx([m[4] for m in unchunked])
+
+  # as do candidates queried a single id at a time
+  monkeypatch.setattr(MnemonicHistogramMatch, 'candidate_batch_size', 1)
+  batched = sorted(MnemonicHistogramMatch.match(source, target))
+  assert [m[:4] for m in batched] == [m[:4] for m in unchunked]
+  assert [m[4] for m in batched] == pytest.approx([m[4] for m in unchunked])
+
+  # many identical tiny histograms only contribute a bounded number of
+  # candidates per source histogram
+  settings.HISTOGRAM_INDEX_MAX_BUCKET_SIZE = 2
+  thunks = create_vectors(admin_user, 'thunks', [{'jmp': 1}] * 20)
+  thunk_sources = thunks.filter(instance__offset__lt=3)
+  thunk_matches = list(MnemonicHistogramMatch.match(thunk_sources, thunks))
+  assert thunk_matches
+  assert len(thunk_matches) <= 3 * settings.HISTOGRAM_INDEX_BANDS * 2
+
+
+@pytest.mark.django_db
+def test_index_vectors_command(admin_user, settings):
+  vectors = create_vectors(admin_user, 'source', hists)
+  HistogramBucket.objects.all().delete()
+
+  call_command('index_vectors')
+  bucket_count = HistogramBucket.objects.count()
+  assert bucket_count == len(vectors) * settings.HISTOGRAM_INDEX_BANDS
+
+  call_command('index_vectors')
+  assert HistogramBucket.objects.count() == bucket_count
+
+
+@pytest.mark.django_db
+def test_hash_match_in_db(admin_user):
+  source = create_vectors(admin_user, 'source', hists[:3],
+                          ['assembly_hash'] * 3)
+  target = create_vectors(admin_user, 'target', hists + hists[:1],
+                          ['assembly_hash'] * 6)
+  task = Task.objects.create(owner=admin_user,
+                             source_file_version_id=source[0].file_version_id)
+
+  expected = set(AssemblyHashMatch.match(source, target))
+  assert len(expected) == 4
+
+  match_count = AssemblyHashMatch.match_in_db(task.id, source, target)
+  assert match_count == len(expected)
+  matches = task.matches.values_list('from_vector_id', 'from_instance_id',
+                                     'to_vector_id', 'to_instance_id', 'score',
+                                     'type')
+  assert set(matches) == expected
+  assert set(task.matches.values_list('type', flat=True)) == {'assembly_hash'}
+
+
+@pytest.mark.django_db
+def test_identity_hash_match(admin_user):
+  source = create_vectors(admin_user, 'source', hists[:3],
+                          ['assembly_hash', 'mnemonic_hash', 'mnemonic_hash'])
+  target = create_vectors(admin_user, 'target', hists,
+                          ['assembly_hash', 'mnemonic_hist', 'mnemonic_hash',
+                           'mnemonic_hist', 'mnemonic_hist'])
+
+  matches = list(IdentityHashMatch.match(source, target))
+  assert sorted(m[5] for m in matches) == ['assembly_hash', 'mnemonic_hash']
+  matched_offsets = [(Vector.objects.get(id=m[0]).instance.offset,
+                      Vector.objects.get(id=m[2]).instance.offset)
+                     for m in matches]
+  assert sorted(matched_offsets) == [(0, 0), (2, 2)]
+
+
+@pytest.mark.django_db
+def test_match_task(admin_user, settings):
+  settings.MATCH_SOURCE_CHUNK_SIZE = 2
+  source = create_vectors(admin_user, 'source', hists[:4],
+                          ['assembly_hash'] + ['mnemonic_hist'] * 3)
+  create_vectors(admin_user, 'target', hists,
+                 ['assembly_hash'] + ['mnemonic_hist'] * 4)
+  task = Task.objects.create(owner=admin_user, top_k=1,
+                             source_file_version_id=source[0].file_version_id)
+
+  tasks.match(task.id)
+
+  task.refresh_from_db()
+  assert task.status == Task.STATUS_DONE
+  # one identity chunk and two histogram chunks
+  assert task.progress == task.progress_max == 3
+  assert task.matches.filter(type='assembly_hash').count() == 1
+  hist_matches = task.matches.filter(type='mnemonic_hist')
+  assert hist_matches.count() == 3
+  assert all(m.score == pytest.approx(100) for m in hist_matches)
+
+
+@pytest.mark.django_db
+def test_match_task_sharded(admin_user, settings):
+  settings.MATCH_TARGET_SHARD_SIZE = 1
+  source = create_vectors(admin_user, 'source', hists[:2])
+  create_vectors(admin_user, 'target1', hists)
+  create_vectors(admin_user, 'target2', hists[1:])
+  task = Task.objects.create(owner=admin_user, top_k=1,
+                             source_file_version_id=source[0].file_version_id)
+
+  tasks.match(task.id)
+
+  task.refresh_from_db()
+  assert task.status == Task.STATUS_DONE
+  # one chunk of source vectors against each of the two target files
+  assert task.progress == task.progress_max == 2
+  for source_vector in source:
+    assert task.matches.filter(from_vector=source_vector).count() == 1
+
+
+@pytest.mark.django_db
+def test_match_task_methods(admin_client, admin_user):
+  source = create_vectors(admin_user, 'source', hists[:2],
+                          ['assembly_hash', 'mnemonic_hist'])
+  target = create_vectors(admin_user, 'target', hists[:2],
+                          ['assembly_hash', 'mnemonic_hist'])
+
+  task_data = {'source_file_version': source[0].file_version_id,
+               'target_file': target[0].file_id, 'methods': ['identity']}
+  response = admin_client.post('/collab/tasks/', data=json.dumps(task_data),
+                               content_type="application/json")
+  assert response.status_code == 201
+  assert response.data['methods'] == ['identity']
+
+  task = Task.objects.get(id=response.data['id'])
+  assert task.get_methods() == ['identity']
+  assert task.status == Task.STATUS_DONE
+  # histogram matching was skipped entirely
+  assert task.progress == task.progress_max == 1
+  assert set(task.matches.values_list('type', flat=True)) == {'assembly_hash'}
+
+  task_data = {'source_file_version': source[0].file_version_id,
+               'target_file': target[0].file_id, 'methods': ['exact']}
+  response = admin_client.post('/collab/tasks/', data=json.dumps(task_data),
+                               content_type="application/json")
+  assert response.status_code == 400
+
+
+@pytest.mark.django_db
+def test_match_task_reuse(admin_client, admin_user):
+  source = create_vectors(admin_user, 'source', hists[:2])
+  target = create_vectors(admin_user, 'target', hists)
+
+  def post_task(**task_data):
+    task_data.update(source_file_version=source[0].file_version_id,
+                     target_file=target[0].file_id)
+    return admin_client.post('/collab/tasks/', data=json.dumps(task_data),
+                             content_type="application/json")
+
+  response = post_task()
+  assert response.status_code == 201
+  assert response.data['newly_created']
+  task_id = response.data['id']
+  assert Task.objects.get(id=task_id).status == Task.STATUS_DONE
+
+  # an equivalent task against unchanged targets reuses the completed task
+  response = post_task()
+  assert response.status_code == 200
+  assert not response.data['newly_created']
+  assert response.data['id'] == task_id
+  assert Task.objects.count() == 1
+
+  # different task options are not equivalent
+  response = post_task(top_k=1)
+  assert response.status_code == 201
+  assert response.data['id'] != task_id
+
+  # neither are tasks created after vectors were added to the targets
+  instance = Instance.objects.create(owner=admin_user, offset=10,
+                                     file_version_id=target[0].file_version_id,
+                                     type='function')
+  Vector.objects.create(instance=instance, file_id=target[0].file_id,
+                        file_version_id=target[0].file_version_id,
+                        type='assembly_hash', type_version=0,
+                        data=hashlib.md5(b'data').hexdigest())
+  response = post_task()
+  assert response.status_code == 201
+  assert response.data['id'] != task_id
+  assert Task.objects.count() == 3
+
+
+@pytest.mark.parametrize('max_size, queue', [(100, 'interactive'),
+                                             (99, 'bulk')])
+@pytest.mark.django_db
+def test_match_task_routing(admin_client, admin_user, settings, monkeypatch,
+                            max_size, queue):
+  settings.MATCH_INTERACTIVE_MAX_SIZE = max_size
+  source = create_vectors(admin_user, 'source', hists * 4)
+  target = create_vectors(admin_user, 'target', hists)
+
+  sent = []
+  monkeypatch.setattr(tasks.match, 'apply_async',
+                      lambda **kwargs: sent.append(kwargs))
+
+  # 20 source vectors and 5 target vectors
+  task_data = {'source_file_version': source[0].file_version_id,
+               'target_file': target[0].file_id}
+  response = admin_client.post('/collab/tasks/', data=json.dumps(task_data),
+                               content_type="application/json")
+  assert response.status_code == 201
+  assert Task.objects.get(id=response.data['id']).queue == queue
+  assert sent == [{'kwargs': {'task_id': response.data['id'],
+                              'incremental': False},
+                   'queue': queue, 'routing_key': queue,
+                   'priority': settings.MATCH_QUEUE_PRIORITIES[queue]}]
+
+
+def test_chord_unlock_routing():
+  # chord callbacks are polled for by chord_unlock, which must not wait
+  # behind bulk subtasks
+  route = celery_app.amqp.router.route({}, 'celery.chord_unlock')
+  assert route['queue'].name == 'control'
+
+
+@pytest.mark.django_db
+def test_match_task_refresh(admin_client, admin_user, settings):
+  settings.HISTOGRAM_INDEX_ENABLED = False
+  source = create_vectors(admin_user, 'source', hists[:2])
+  target = create_vectors(admin_user, 'target1', hists)
+  project = target[0].file.project
+  task_data = {'source_file_version': source[0].file_version_id,
+               'target_project': project.id}
+  response = admin_client.post('/collab/tasks/', data=json.dumps(task_data),
+                               content_type="application/json")
+  task = Task.objects.get(id=response.data['id'])
+  assert task.status == Task.STATUS_DONE
+  assert list(task.covered_file_versions.all()) == [target[0].file_version]
+  match_ids = set(task.matches.values_list('id', flat=True))
+  assert len(match_ids) == 10
+
+  new_target = create_vectors(admin_user, 'target2', hists[:3],
+                              project=project)
+  response = admin_client.post('/collab/tasks/{}/refresh/'.format(task.id))
+  assert response.status_code == 200
+
+  task.refresh_from_db()
+  assert task.status == Task.STATUS_DONE
+  assert set(task.covered_file_versions.all()) == {target[0].file_version,
+                                                   new_target[0].file_version}
+  # existing matches are kept, and only new file versions were matched
+  assert match_ids.issubset(task.matches.values_list('id', flat=True))
+  new_matches = task.matches.exclude(id__in=match_ids)
+  assert new_matches.count() == 6
+  assert set(new_matches.values_list('to_vector__file_version', flat=True)) \
+    == {new_target[0].file_version_id}
+
+  # the refreshed task covers its targets again and can be reused
+  response = admin_client.post('/collab/tasks/', data=json.dumps(task_data),
+                               content_type="application/json")
+  assert response.status_code == 200
+  assert response.data['id'] == task.id
+
+  # vectors added to an already covered file version are matched as well
+  match_ids = set(task.matches.values_list('id', flat=True))
+  file_version = target[0].file_version
+  instance = Instance.objects.create(owner=admin_user,
+                                     file_version=file_version,
+                                     type='function', offset=100)
+  vector = Vector(instance=instance, file=file_version.file,
+                  file_version=file_version, type='mnemonic_hist',
+                  type_version=0, data=json.dumps(hists[0]))
+  packing.pack_vectors([vector])
+  vector.save()
+
+  response = admin_client.post('/collab/tasks/', data=json.dumps(task_data),
+                               content_type="application/json")
+  assert response.status_code == 201
+  Task.objects.filter(id=response.data['id']).delete()
+
+  response = admin_client.post('/collab/tasks/{}/refresh/'.format(task.id))
+  assert response.status_code == 200
+  new_matches = task.matches.exclude(id__in=match_ids)
+  assert set(new_matches.values_list('to_vector', flat=True)) == {vector.id}
+  assert new_matches.count() == 2
+
+  response = admin_client.post('/collab/tasks/', data=json.dumps(task_data),
+                               content_type="application/json")
+  assert response.status_code == 200
+  assert response.data['id'] == task.id
+
+
+@pytest.mark.parametrize('cascade_targets', [False, True])
+@pytest.mark.django_db
+def test_match_task_cascade(admin_user, settings, cascade_targets):
+  settings.HISTOGRAM_INDEX_ENABLED = False
+  settings.MATCH_SOURCE_CHUNK_SIZE = 1
+  # the first source function is an identical copy of the first target
+  # function, so it is resolved by its hash
+  source = create_vectors(admin_user, 'source', hists[:2] + hists[:1],
+                          ['mnemonic_hist', 'mnemonic_hist', 'assembly_hash'])
+  source_instances = source.order_by('instance__offset')
+  source_instances = [vector.instance_id for vector in source_instances]
+  Vector.objects.filter(id=source[2].id).update(
+    instance_id=source_instances[0])
+  target = create_vectors(admin_user, 'target', hists[:2] + hists[:1],
+                          ['mnemonic_hist', 'mnemonic_hist', 'assembly_hash'])
+  target_instances = target.order_by('instance__offset')
+  target_instances = [vector.instance_id for vector in target_instances]
+  Vector.objects.filter(id=target[2].id).update(
+    instance_id=target_instances[0])
+  task = Task.objects.create(owner=admin_user, cascade=True,
+                             cascade_targets=cascade_targets,
+                             source_file_version_id=source[0].file_version_id)
+
+  tasks.match(task.id)
+
+  task.refresh_from_db()
+  assert task.status == Task.STATUS_DONE
+  # one identity chunk, and a single histogram chunk out of the two planned
+  assert task.progress == task.progress_max == 2
+  assert task.matches.filter(type='assembly_hash').count() == 1
+
+  hist_matches = task.matches.filter(type='mnemonic_hist')
+  assert set(hist_matches.values_list('from_instance_id', flat=True)) == \
+    {source_instances[1]}
+  to_instances = set(hist_matches.values_list('to_instance_id', flat=True))
+  if cascade_targets:
+    assert to_instances == {target_instances[1]}
+  else:
+    assert to_instances == set(target_instances[:2])
+
+
+@pytest.mark.django_db
+def test_task_wait(admin_client, admin_user, settings, monkeypatch):
+  settings.TASK_WAIT_INTERVAL = 1
+  settings.TASK_WAIT_MAX_INTERVAL = 2
+  source = create_vectors(admin_user, 'source', hists[:1])
+  task = Task.objects.create(owner=admin_user, status=Task.STATUS_STARTED,
+                             source_file_version_id=source[0].file_version_id)
+  wait_url = '/collab/tasks/{}/wait/'.format(task.id)
+
+  sleeps = []
+
+  def advance_task(interval):
+    sleeps.append(interval)
+    if len(sleeps) == 3:
+      Task.objects.filter(id=task.id).update(progress=1)
+  monkeypatch.setattr(views.time, 'sleep', advance_task)
+
+  # held until the task changes
+  response = admin_client.get(wait_url, {'status': 'started', 'progress': 0})
+  assert response.status_code == 200
+  assert response.data['progress'] == 1
+  assert sleeps == [1, 2, 2]
+
+  # returned right away once the client is behind
+  response = admin_client.get(wait_url, {'status': 'started', 'progress': 0})
+  assert response.data['progress'] == 1
+  assert len(sleeps) == 3
+
+  # or once the timeout passes
+  settings.TASK_WAIT_TIMEOUT = 0
+  response = admin_client.get(wait_url, {'status': 'started', 'progress': 1})
+  assert response.data['progress'] == 1
+
+  # finished tasks never change
+  settings.TASK_WAIT_TIMEOUT = 30
+  Task.objects.filter(id=task.id).update(status=Task.STATUS_DONE)
+  response = admin_client.get(wait_url)
+  assert response.data['status'] == Task.STATUS_DONE
+  assert len(sleeps) == 3
+
+  response = admin_client.get(wait_url, {'progress': 'a'})
+  assert response.status_code == 400
+
+
+@pytest.mark.django_db
+def test_lookup(admin_client, admin_user):
+  source = create_vectors(admin_user, 'source', hists[:1] * 2,
+                          ['assembly_hash', 'mnemonic_hist'])
+  target = create_vectors(admin_user, 'target', hists[:3] * 2,
+                          ['assembly_hash'] * 3 + ['mnemonic_hist'] * 3)
+  target_vectors = {(vector.type, vector.instance.offset): vector
+                    for vector in target}
+
+  def post_lookup(lookup_data):
+    return admin_client.post('/collab/instances/lookup/',
+                             data=json.dumps(lookup_data),
+                             content_type="application/json")
+
+  # vectors of a function which was not uploaded
+  vectors = [{'type': vector.type, 'type_version': 0,
+              'data': packing.unpack_data(vector)} for vector in source]
+  response = post_lookup({'vectors': vectors, 'top_k': 2,
+                          'target_file': target[0].file_id})
+  assert response.status_code == 200
+  lookup_matches = response.data['matches']
+  assert [(m['type'], m['offset']) for m in lookup_matches] == \
+    [('assembly_hash', 0), ('mnemonic_hist', 3), ('mnemonic_hist', 5)]
+  assert lookup_matches[0]['to_vector'] == \
+    target_vectors['assembly_hash', 0].id
+  assert lookup_matches[0]['from_vector'] is None
+  assert lookup_matches[0]['file'] == target[0].file_id
+  assert lookup_matches[1]['score'] == pytest.approx(100)
+  assert lookup_matches[1]['to_instance'] == \
+    target_vectors['mnemonic_hist', 3].instance_id
+
+  # an uploaded instance, limited to identity matches
+  response = post_lookup({'instance': source[0].instance_id,
+                          'methods': ['identity']})
+  assert response.status_code == 200
+  assert [(m['type'], m['from_vector']) for m in response.data['matches']] \
+    == [('assembly_hash', source[0].id)]
+
+  response = post_lookup({'instance': source[0].instance_id,
+                          'vectors': vectors})
+  assert response.status_code == 400
+
+  # unpacked vectors of an uploaded instance are left out
+  for vector in source:
+    vector.data = packing.unpack_data(vector)
+    vector.digest_high = vector.digest_low = vector.packed = None
+    vector.save()
+  for instance_id in (source[0].instance_id, source[1].instance_id):
+    response = post_lookup({'instance': instance_id})
+    assert response.status_code == 200
+    assert response.data['matches'] == []
+
+
+@pytest.mark.django_db
+def test_lookup_read_only(admin_client, admin_user, settings):
+  settings.HISTOGRAM_INDEX_ENABLED = False
+  settings.HISTOGRAM_MATRIX_CACHE_DIR = None
+  target = create_vectors(admin_user, 'target', hists[:1], ['assembly_hash'])
+  mnemonic_count = Mnemonic.objects.count()
+
+  # unknown mnemonics are not added to the vocabulary, and targets without
+  # vectors of a looked up type are not an error
+  vectors = [{'type': 'mnemonic_hist', 'type_version': 0,
+              'data': json.dumps({'unknown': 1, 'mov': 2})}]
+  response = admin_client.post('/collab/instances/lookup/',
+                               data=json.dumps({'vectors': vectors}),
+                               content_type="application/json")
+  assert response.status_code == 200
+  assert response.data['matches'] == []
+  assert Mnemonic.objects.count() == mnemonic_count
+  assert target.count() == 1
+
+
+@pytest.mark.django_db
+def test_match_pagination(admin_client, admin_user, settings):
+  settings.HISTOGRAM_INDEX_ENABLED = False
+  source = create_vectors(admin_user, 'source', hists[:2])
+  create_vectors(admin_user, 'target', hists)
+  task = Task.objects.create(owner=admin_user,
+                             source_file_version_id=source[0].file_version_id)
+  tasks.match(task.id)
+  expected = list(task.matches.order_by('-score', '-id')
+                              .values_list('id', flat=True))
+  assert len(expected) == 10
+
+  results = []
+  url = '/collab/matches/?task={}&page_size=3'.format(task.id)
+  while url:
+    response = admin_client.get(url)
+    assert response.status_code == 200
+    assert len(response.data['results']) <= 3
+    results.extend(response.data['results'])
+    url = response.data['next']
+  assert [result['id'] for result in results] == expected
+
+  match_obj = task.matches.get(id=results[0]['id'])
+  assert results[0]['from_instance'] == match_obj.from_instance_id
+  assert results[0]['from_offset'] == match_obj.from_instance.offset
+  assert results[0]['to_offset'] == match_obj.to_instance.offset
+
+  response = admin_client.get('/collab/matches/', {'task': task.id,
+                                                   'score__gte': 50,
+                                                   'score__lt': 100})
+  scores = [result['score'] for result in response.data['results']]
+  assert scores and all(50 <= score < 100 for score in scores)
+  assert len(scores) == task.matches.filter(score__gte=50,
+                                            score__lt=100).count()
+
+  response = admin_client.get('/collab/matches/', {'cursor': 'invalid'})
+  assert response.status_code == 404
+
+
+@pytest.mark.django_db
+def test_match_summary(admin_client, admin_user, settings):
+  settings.HISTOGRAM_INDEX_ENABLED = False
+  source = create_vectors(admin_user, 'source', hists[:2] + hists[:1],
+                          ['mnemonic_hist'] * 2 + ['assembly_hash'])
+  target = create_vectors(admin_user, 'target', hists[:2] + hists[:1],
+                          ['mnemonic_hist'] * 2 + ['assembly_hash'])
+  for vector in target:
+    Annotation.objects.create(instance=vector.instance, type='name',
+                              data='target_{}'.format(vector.instance.offset))
+  task = Task.objects.create(owner=admin_user,
+                             source_file_version_id=source[0].file_version_id)
+  tasks.match(task.id)
+
+  response = admin_client.get('/collab/tasks/{}/summary/'.format(task.id))
+  assert response.status_code == 200
+  summary = [(m['from_offset'], m['type'], m['to_offset'], m['to_name'])
+             for m in response.data]
+  assert summary == [(0, 'mnemonic_hist', 0, 'target_0'),
+                     (1, 'mnemonic_hist', 1, 'target_1'),
+                     (2, 'assembly_hash', 2, 'target_2')]
+  assert response.data[0]['score'] == pytest.approx(100)
+  assert response.data[0]['to_file_version'] == target[0].file_version_id
+
+  # summaries are rebuilt rather than appended to
+  tasks.summarize_matches(task.id)
+  assert task.best_matches.count() == 3
+
+  response = admin_client.get('/collab/tasks/{}/summary/'.format(task.id),
+                              {'type': 'assembly_hash'})
+  assert [m['from_offset'] for m in response.data] == [2]
+
+
+@pytest.mark.parametrize('batch_size', [1, 2, 1000])
+@pytest.mark.django_db
+def test_merge_top_k(admin_user, batch_size):
+  source = create_vectors(admin_user, 'source', hists[:3])
+  target = create_vectors(admin_user, 'target', hists[:1])[0]
+  task = Task.objects.create(owner=admin_user,
+                             source_file_version_id=source[0].file_version_id)
+  scores = [10, 40, 30, 40, 20]
+  Match.objects.bulk_create(
+    Match(task=task, type='mnemonic_hist', score=score,
+          from_vector=vector, from_instance_id=vector.instance_id,
+          to_vector=target, to_instance_id=target.instance_id)
+    for vector in source for score in scores)
+
+  tasks.merge_top_k(task.id, 'mnemonic_hist', 2, batch_size=batch_size)
+  for vector in source:
+    vector_matches = task.matches.filter(from_vector=vector)
+    assert sorted(vector_matches.values_list('score', flat=True)) == [40, 40]
+
+
+@pytest.mark.django_db
+def test_insert_batches(admin_user, monkeypatch):
+  source = create_vectors(admin_user, 'source', hists[:1])
+  target = create_vectors(admin_user, 'target', hists)
+  task = Task.objects.create(owner=admin_user,
+                             source_file_version_id=source[0].file_version_id)
+
+  inserted = []
+
+  def gen_matches():
+    for target_vector in target:
+      # every completed batch is already in the database
+      assert task.matches.count() == sum(inserted)
+      yield Match(task=task, from_vector=source[0], to_vector=target_vector,
+                  from_instance_id=source[0].instance_id,
+                  to_instance_id=target_vector.instance_id, score=50,
+                  type='mnemonic_hist')
+
+  bulk_create = Match.objects.bulk_create
+
+  def record_bulk_create(objs, *args, **kwargs):
+    inserted.append(len(objs))
+    return bulk_create(objs, *args, **kwargs)
+  monkeypatch.setattr(Match.objects, 'bulk_create', record_bulk_create)
+
+  assert tasks.insert_batches(gen_matches(), 2) == 5
+  assert inserted == [2, 2, 1]
+  assert task.matches.count() == 5
+
+
+@pytest.mark.django_db
+def test_vector_packing(admin_client, admin_user):
+  source = create_vectors(admin_user, 'source', hists[:1],
+                          ['mnemonic_hist'])
+  instance_id = source[0].instance_id
+  file_version_id = source[0].file_version_id
+
+  digest = hashlib.md5(b'data').hexdigest()
+  vectors = [{'instance': instance_id, 'file_version': file_version_id,
+              'type': 'mnemonic_hist', 'type_version': 0,
+              'data': json.dumps(hists[4])},
+             {'instance': instance_id, 'file_version': file_version_id,
+              'type': 'assembly_hash', 'type_version': 0, 'data': digest}]
+  for vector in vectors:
+    response = admin_client.post('/collab/vectors/', data=json.dumps(vector),
+                                 content_type="application/json")
+    assert response.status_code == 201
+
+  hist_vector, hash_vector = Vector.objects.order_by('-id')[:2][::-1]
+  assert hist_vector.data == '' and hist_vector.packed
+  assert hash_vector.data == '' and hash_vector.digest_high is not None
+  assert hist_vector.buckets.exists()
+
+  response = admin_client.get('/collab/vectors/{}/'.format(hist_vector.id))
+  assert json.loads(response.json()['data']) == hists[4]
+  response = admin_client.get('/collab/vectors/{}/'.format(hash_vector.id))
+  assert response.json()['data'] == digest
+
+  # partial updates validate and repack the data they leave unchanged
+  hist_url = '/collab/vectors/{}/'.format(hist_vector.id)
+  hash_url = '/collab/vectors/{}/'.format(hash_vector.id)
+  response = admin_client.patch(hist_url, data=json.dumps({'type_version': 1}),
+                                content_type="application/json")
+  assert response.status_code == 200
+  assert json.loads(response.json()['data']) == hists[4]
+
+  response = admin_client.patch(hash_url,
+                                data=json.dumps({'type': 'mnemonic_hist'}),
+                                content_type="application/json")
+  assert response.status_code == 400
+
+  response = admin_client.patch(hist_url,
+                                data=json.dumps({'type': 'assembly_hash'}),
+                                content_type="application/json")
+  assert response.status_code == 200
+  hist_vector.refresh_from_db()
+  assert hist_vector.packed is None and hist_vector.digest_high is not None
+  assert json.loads(hist_vector.data) == hists[4]
+
+
+@pytest.mark.django_db
+def test_mnemonic_vocabulary(admin_user, settings):
+  settings.HISTOGRAM_INDEX_ENABLED = False
+  version_0 = packing.get_mnemonic_ids(['mov', 'push'], 0)
+  assert packing.get_mnemonic_ids(['push', 'mov'], 0) == version_0
+
+  # vocabulary only grows, existing mnemonic ids are kept
+  grown = packing.get_mnemonic_ids(['mov', 'push', 'xor'], 0)
+  assert dict(grown, xor=None) == dict(version_0, xor=None)
+
+  version_1 = packing.get_mnemonic_ids(['mov', 'push'], 1)
+  assert set(version_1.values()).isdisjoint(version_0.values())
+  assert Mnemonic.objects.count() == 5
+
+  # histograms of different type versions never share columns
+  source = create_vectors(admin_user, 'source', hists[:1])
+  target = create_vectors(admin_user, 'target', hists[:1], type_version=1)
+  scores = [m[4] for m in MnemonicHistogramMatch.match(source, target)]
+  assert scores == [pytest.approx(100 * (1 - 2 ** 0.5))]
+
+
+@pytest.mark.django_db(transaction=True)
+def test_mnemonic_vocabulary_cache(monkeypatch):
+  monkeypatch.setattr(packing, '_mnemonic_ids', {})
+  mnemonic_ids = packing.get_mnemonic_ids(['mov', 'push'], 0)
+  assert packing._mnemonic_ids == {(0, 'mov'): mnemonic_ids['mov'],
+                                   (0, 'push'): mnemonic_ids['push']}
+
+  # ids of mnemonics created in a rolled back transaction are not cached
+  monkeypatch.setattr(packing, '_mnemonic_ids', {})
+  with pytest.raises(RuntimeError):
+    with transaction.atomic():
+      packing.get_mnemonic_ids(['xor'], 0)
+      raise RuntimeError()
+  assert packing._mnemonic_ids == {}
+  assert not Mnemonic.objects.filter(name='xor').exists()
+
+
+@pytest.mark.django_db
+def test_instance_batch_upload(admin_client, admin_user,
+                               django_assert_max_num_queries):
+  source = create_vectors(admin_user, 'source', hists[:1])
+  file_version_id = source[0].file_version_id
+
+  instances = [{'file_version': file_version_id, 'type': 'function',
+                'offset': 100 + offset,
+                'vectors': [{'type': 'mnemonic_hist', 'type_version': 0,
+                             'data': json.dumps(hist)},
+                            {'type': 'assembly_hash', 'type_version': 0,
+                             'data': hashlib.md5(b'data').hexdigest()}],
+                'annotations': [{'type': 'name',
+                                 'data': 'func_{}'.format(offset)}]}
+               for offset, hist in enumerate(hists * 10)]
+
+  # statements don't depend on the number of instances in a batch
+  with django_assert_max_num_queries(25):
+    response = admin_client.post('/collab/instances/',
+                                 data=json.dumps(instances),
+                                 content_type="application/json")
+  assert response.status_code == 201
+  assert len(response.data) == 50
+
+  for instance, response_instance in zip(instances, response.data):
+    obj = Instance.objects.get(id=response_instance['id'])
+    assert obj.offset == instance['offset']
+    assert response_instance['offset'] == instance['offset']
+    assert [json.loads(vector['data']) for vector in instance['vectors'][:1]] \
+      == [json.loads(vector['data'])
+          for vector in response_instance['vectors']
+          if vector['type'] == 'mnemonic_hist']
+    assert obj.vectors.count() == 2
+    assert obj.vectors.filter(type='mnemonic_hist')[0].buckets.exists()
+    assert list(obj.annotations.values_list('data', flat=True)) == \
+      [instance['annotations'][0]['data']]
+
+
+@pytest.mark.parametrize('compress', [False, True])
+@pytest.mark.django_db
+def test_instance_stream_upload(admin_client, admin_user, settings, compress):
+  settings.INSTANCE_STREAM_BATCH_SIZE = 3
+  source = create_vectors(admin_user, 'source', hists[:1])
+  file_version_id = source[0].file_version_id
+
+  lines = [json.dumps({'file_version': file_version_id, 'type': 'function',
+                       'offset': 100 + offset,
+                       'vectors': [{'type': 'mnemonic_hist',
+                                    'type_version': 0,
+                                    'data': json.dumps(hist)}],
+                       'annotations': []})
+           for offset, hist in enumerate(hists + hists[:2])]
+  lines.insert(2, '{"file_version": ')
+  lines.insert(5, json.dumps({'file_version': file_version_id}))
+  body = ('\n'.join(lines) + '\n').encode('ascii')
+
+  extra = {}
+  if compress:
+    body = gzip_compress(body)
+    extra['HTTP_CONTENT_ENCODING'] = 'gzip'
+  response = admin_client.post('/collab/instances/stream/', data=body,
+                               content_type='application/x-ndjson', **extra)
+  assert response.status_code == 200
+  assert response.data['accepted'] == 7
+  assert response.data['skipped'] == 0
+  assert response.data['rejected'] == 2
+  assert [error['line'] for error in response.data['errors']] == [3, 6]
+  assert 'vectors' in response.data['errors'][1]['errors']
+
+  uploaded = Instance.objects.filter(offset__gte=100).order_by('offset')
+  assert [instance.offset for instance in uploaded] == list(range(100, 107))
+  assert all(instance.vectors.count() == 1 for instance in uploaded)
+  assert all(instance.owner == admin_user for instance in uploaded)
+
+  # replaying an upload, as a retried batch does, skips stored instances
+  response = admin_client.post('/collab/instances/stream/', data=body,
+                               content_type='application/x-ndjson', **extra)
+  assert response.status_code == 200
+  assert response.data['accepted'] == 0
+  assert response.data['skipped'] == 7
+  assert uploaded.count() == 7
+  assert Vector.objects.filter(instance__in=uploaded).count() == 7
+
+  response = admin_client.post('/collab/instances/stream/',
+                               data=b'not gzip data',
+                               content_type='application/x-ndjson',
+                               HTTP_CONTENT_ENCODING='gzip')
+  assert response.status_code == 400
+
+
+@pytest.mark.django_db
+def test_gzip_request(admin_client, admin_user):
+  body = json.dumps({'name': 'compressed', 'description': 'gzip request',
+                     'private': False, 'files': []}).encode('ascii')
+  response = admin_client.post('/collab/projects/', data=gzip_compress(body),
+                               content_type='application/json',
+                               HTTP_CONTENT_ENCODING='gzip')
+  assert response.status_code == 201
+  assert Project.objects.filter(name='compressed').exists()
+
+  response = admin_client.post('/collab/projects/', data=b'not gzip data',
+                               content_type='application/json',
+                               HTTP_CONTENT_ENCODING='gzip')
+  assert response.status_code == 400
+
+
+@pytest.mark.django_db
+def test_gzip_request_limits(admin_client, admin_user, settings):
+  settings.DATA_UPLOAD_MAX_MEMORY_SIZE = 1024 * 1024
+  settings.REQUEST_STREAM_MAX_LINE_SIZE = 1024 * 1024
+
+  # a small compressed body expanding past the limits is rejected
+  body = gzip_compress(b' ' * (settings.DATA_UPLOAD_MAX_MEMORY_SIZE + 1))
+  assert len(body) < 10 * 1024
+  response = admin_client.post('/collab/projects/', data=body,
+                               content_type='application/json',
+                               HTTP_CONTENT_ENCODING='gzip')
+  assert response.status_code == 400
+
+  body = gzip_compress(b'{' * (settings.REQUEST_STREAM_MAX_LINE_SIZE + 1))
+  response = admin_client.post('/collab/instances/stream/', data=body,
+                               content_type='application/x-ndjson',
+                               HTTP_CONTENT_ENCODING='gzip')
+  assert response.status_code == 400
+  assert response.data['accepted'] == 0
+
+
+def gzip_compress(data):
+  compressed = io.BytesIO()
+  with gzip.GzipFile(fileobj=compressed, mode='wb') as gzip_file:
+    gzip_file.write(data)
+  return compressed.getvalue()
+
+
+@pytest.mark.django_db
+def test_pack_vectors_command(admin_user):
+  source = create_vectors(admin_user, 'source', hists, ['mnemonic_hist',
+                                                         'assembly_hash'] * 3)
+  expected = {vector.id: packing.unpack_data(vector) for vector in source}
+  for vector in source:
+    vector.data = expected[vector.id]
+    vector.digest_high = vector.digest_low = vector.packed = None
+    vector.save()
+  HistogramBucket.objects.all().delete()
+
+  call_command('pack_vectors')
+
+  for vector in Vector.objects.filter(id__in=expected):
+    assert vector.data == ''
+    assert packing.unpack_data(vector) == expected[vector.id]
+  assert HistogramBucket.objects.exists()
+
+
+@pytest.mark.parametrize('cache', [False, True])
+@pytest.mark.django_db
+def test_unpacked_vectors_skipped(admin_user, settings, matrix_cache_dir,
+                                  cache):
+  settings.HISTOGRAM_INDEX_ENABLED = False
+  if not cache:
+    settings.HISTOGRAM_MATRIX_CACHE_DIR = None
+  source = create_vectors(admin_user, 'source', hists[:2],
+                          ['mnemonic_hist', 'assembly_hash'])
+  target = create_vectors(admin_user, 'target', hists[:2] * 2,
+                          ['mnemonic_hist', 'assembly_hash'] * 2)
+  # vectors stored before vectors were packed on upload
+  for vector in target.filter(instance__offset__gte=2):
+    vector.data = packing.unpack_data(vector)
+    vector.digest_high = vector.digest_low = vector.packed = None
+    vector.save()
+  packed_ids = set(target.filter(instance__offset__lt=2)
+                         .values_list('id', flat=True))
+
+  hist_matches = list(MnemonicHistogramMatch.match(source, target))
+  hash_matches = list(AssemblyHashMatch.match(source, target))
+  assert len(hist_matches) == 1
+  assert len(hash_matches) == 1
+  assert set(m[2] for m in hist_matches + hash_matches) == packed_ids
+
+  task = Task.objects.create(owner=admin_user,
+                             source_file_version_id=source[0].file_version_id)
+  assert AssemblyHashMatch.match_in_db(task.id, source, target) == 1
+
+
+@pytest.mark.django_db
+def test_matrix_cache(admin_user, settings, matrix_cache_dir):
+  settings.HISTOGRAM_INDEX_ENABLED = False
+  source = create_vectors(admin_user, 'source', hists[:2])
+  target = create_vectors(admin_user, 'target', hists)
+  cache_path = matrix_cache.get_path(target[0].file_version_id,
+                                     'mnemonic_hist', 0)
+
+  settings.HISTOGRAM_MATRIX_CACHE_DIR = None
+  uncached = sorted(MnemonicHistogramMatch.match(source, target))
+  settings.HISTOGRAM_MATRIX_CACHE_DIR = matrix_cache_dir
+  assert not os.path.exists(cache_path)
+
+  cached = sorted(MnemonicHistogramMatch.match(source, target))
+  assert os.path.isfile(cache_path)
+  assert [m[:4] for m in cached] == [m[:4] for m in uncached]
+  assert [m[4] for m in cached] == pytest.approx([m[4] for m in uncached])
+
+  # subsets of the cached file version are matched as well
+  subset = target.filter(instance__offset__lt=2)
+  assert len(list(MnemonicHistogramMatch.match(source, subset))) == 4
+
+  # adding vectors to the file version rebuilds its cached matrix
+  instance = Instance.objects.create(owner=admin_user, offset=10,
+                                     file_version_id=target[0].file_version_id,
+                                     type='function')
+  vector = Vector(instance=instance, file_id=target[0].file_id,
+                  file_version_id=target[0].file_version_id,
+                  type='mnemonic_hist', type_version=0,
+                  data=json.dumps(hists[0]))
+  packing.pack_vectors([vector])
+  vector.save()
+  target = Vector.objects.filter(file_id=target[0].file_id)
+  assert len(list(MnemonicHistogramMatch.match(source, target))) == 12
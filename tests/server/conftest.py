@@ -0,0 +1,9 @@
+import pytest
+
+
+@pytest.fixture(autouse=True)
+def celery_eager(settings):
+  """Run celery tasks, chords included, in process instead of sending them
+  to a broker, and raise their exceptions in tests"""
+  settings.CELERY_ALWAYS_EAGER = True
+  settings.CELERY_EAGER_PROPAGATES_EXCEPTIONS = True